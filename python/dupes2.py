@@ -1,22 +1,409 @@
 #!/usr/bin/python
 from datetime import datetime
 from datetime import timedelta
+import Queue
 import argparse
-import md5
+import binascii
+import cProfile
+import collections
+import csv
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import math
 import os
 import re
+import select
 import shutil
+import signal
+import socket
 import sqlite3
-import subprocess
+import struct
 import sys
+import tempfile
+import threading
 import time
+import zlib
+from stat import S_ISDIR, S_ISLNK, S_ISREG
 
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
 
-MD5SUM = [
-  ['md5sum'],   # GNU-style
-  ['md5', '-r'] # BSD-style
+
+# Hash algorithm name -> constructor of a hashlib-style object.
+HASH_ALGORITHMS = {
+  'md5': hashlib.md5,
+  'sha1': hashlib.sha1,
+}
+if hasattr(hashlib, 'blake2b'):
+  HASH_ALGORITHMS['blake2b'] = hashlib.blake2b
+else:
+  try:
+    import pyblake2
+    HASH_ALGORITHMS['blake2b'] = pyblake2.blake2b
+  except ImportError:
+    pass
+try:
+  import xxhash
+  HASH_ALGORITHMS['xxh64'] = xxhash.xxh64
+except ImportError:
+  pass
+
+# Files are hashed by reading chunks of this many bytes.
+HASH_CHUNK_SIZE = 1 << 20
+
+# The partial hash of a file covers this many bytes at its start and this many
+# bytes at its end.
+PARTIAL_HASH_BYTES = 4096
+
+# Content-defined chunking (see ChunkFile): chunks are at least
+# CHUNK_MIN_BYTES and at most CHUNK_MAX_BYTES long. A chunk ends after a
+# CHUNK_ANCHOR byte whose preceding CHUNK_WINDOW bytes have a crc32 with the
+# CHUNK_MASK bits clear, i.e. about every 256 * 4096 bytes past the minimum.
+CHUNK_MIN_BYTES = 256 << 10
+CHUNK_MAX_BYTES = 4 << 20
+CHUNK_ANCHOR = '\x8f'
+CHUNK_WINDOW = 32
+CHUNK_MASK = 0xFFF
+
+# posix_fadvise advice values (Linux).
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+# How much of the next file in disk order is read ahead while hashing.
+PREFETCH_BYTES = 8 << 20
+
+# SplitIdenticalFiles keeps at most this many files open.
+VERIFY_MAX_OPEN_FILES = 256
+
+# ioctl that makes a file share the extents of another file (Linux, on
+# filesystems with reflinks such as btrfs and xfs).
+FICLONE = 0x40049409
+
+# Filesystem types that support FICLONE, and types that do not. Others,
+# such as xfs or zfs, depend on how they were created or configured.
+REFLINK_FILESYSTEMS = frozenset(['btrfs', 'bcachefs', 'ocfs2'])
+NO_REFLINK_FILESYSTEMS = frozenset([
+  'ext2', 'ext3', 'ext4', 'tmpfs', 'ramfs', 'vfat', 'exfat', 'ntfs',
+  'ntfs3', 'fuseblk', 'hfsplus', 'f2fs', 'jfs', 'reiserfs', 'nilfs2',
+  'squashfs', 'iso9660'])
+
+# ioctl that maps the extents of a file (Linux).
+FS_IOC_FIEMAP = 0xC020660B
+# struct fiemap, followed by room for one struct fiemap_extent.
+FIEMAP_HEADER = struct.Struct('=QQIIII')
+FIEMAP_EXTENT = struct.Struct('=QQQQQIIII')
+
+if hasattr(os, 'posix_fadvise'):
+  posix_fadvise = os.posix_fadvise
+else:
+  try:
+    libc = ctypes.CDLL(
+        ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    posix_fadvise = libc.posix_fadvise
+    posix_fadvise.argtypes = [
+        ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+  except (OSError, AttributeError):
+    posix_fadvise = None
+
+def CreatePathIndex(cursor):
+  """Creates file_paths, a trigram index over the full path of each file,
+  kept in sync with file_stats by triggers. It serves LIKE and GLOB queries
+  on substrings of at least 3 characters without scanning file_stats. Does
+  nothing if sqlite lacks the FTS5 trigram tokenizer (sqlite < 3.34).
+  Matches are always checked against full_path, so detail=none only makes
+  the index smaller."""
+  try:
+    cursor.execute(
+        "CREATE VIRTUAL TABLE file_paths USING fts5(full_path, "
+        "tokenize='trigram', detail=none)")
+  except sqlite3.OperationalError:
+    return
+  cursor.execute(
+      "INSERT INTO file_paths (rowid, full_path) "
+      "SELECT rowid, path || '/' || base_name FROM file_stats")
+  # INSERT OR REPLACE only runs the delete trigger with recursive_triggers.
+  cursor.execute(
+      "CREATE TRIGGER file_paths_insert AFTER INSERT ON file_stats BEGIN "
+      "INSERT INTO file_paths (rowid, full_path) "
+      "VALUES (new.rowid, new.path || '/' || new.base_name); END")
+  cursor.execute(
+      "CREATE TRIGGER file_paths_delete AFTER DELETE ON file_stats BEGIN "
+      "DELETE FROM file_paths WHERE rowid=old.rowid; END")
+  cursor.execute(
+      "CREATE TRIGGER file_paths_update AFTER UPDATE OF path, base_name "
+      "ON file_stats BEGIN "
+      "UPDATE file_paths SET full_path=new.path || '/' || new.base_name "
+      "WHERE rowid=old.rowid; END")
+
+
+def CreateDirectoryPathIndex(cursor):
+  """Like CreatePathIndex, for file_stats rows that refer to their directory
+  by dir_id."""
+  try:
+    cursor.execute(
+        "CREATE VIRTUAL TABLE file_paths USING fts5(full_path, "
+        "tokenize='trigram', detail=none)")
+  except sqlite3.OperationalError:
+    return
+  cursor.execute(
+      "INSERT INTO file_paths (rowid, full_path) "
+      "SELECT f.rowid, d.path || '/' || f.base_name "
+      "FROM file_stats f JOIN dirs d ON d.dir_id=f.dir_id")
+  cursor.execute(
+      "CREATE TRIGGER file_paths_insert AFTER INSERT ON file_stats BEGIN "
+      "INSERT INTO file_paths (rowid, full_path) VALUES (new.rowid, "
+      "(SELECT path FROM dirs WHERE dir_id=new.dir_id) || '/' || "
+      "new.base_name); END")
+  cursor.execute(
+      "CREATE TRIGGER file_paths_delete AFTER DELETE ON file_stats BEGIN "
+      "DELETE FROM file_paths WHERE rowid=old.rowid; END")
+  cursor.execute(
+      "CREATE TRIGGER file_paths_update AFTER UPDATE OF dir_id, base_name "
+      "ON file_stats BEGIN "
+      "UPDATE file_paths SET full_path="
+      "(SELECT path FROM dirs WHERE dir_id=new.dir_id) || '/' || "
+      "new.base_name WHERE rowid=old.rowid; END")
+
+
+def MigrateToDirectoryIds(cursor):
+  """Rewrites file_stats and chunks in the compact format: each file row
+  refers to its directory by an integer dir_id into dirs instead of holding
+  the full directory path, and digests are stored as BLOBs, half the size of
+  hex text. Digests that are not valid hex become NULL, so those files are
+  hashed again. Runs in place, within the upgrade transaction; the freed
+  pages are released by the next --vacuum or --prune."""
+  cursor.execute(
+      'CREATE TABLE dirs (dir_id integer PRIMARY KEY, '
+      'path text NOT NULL UNIQUE)')
+  cursor.execute(
+      'INSERT INTO dirs (path) SELECT DISTINCT path FROM file_stats '
+      'WHERE path IS NOT NULL ORDER BY path')
+  for trigger in ('insert', 'delete', 'update'):
+    cursor.execute('DROP TRIGGER IF EXISTS file_paths_%s' % trigger)
+  cursor.execute('DROP TABLE IF EXISTS file_paths')
+  cursor.execute(
+      'CREATE TABLE file_stats_v2 (dir_id integer, base_name text, '
+      'md5hash blob, size integer, timestamp_seconds integer, '
+      "algorithm text NOT NULL DEFAULT 'md5', partial_hash blob, "
+      'device integer, inode integer, mtime_ns integer, '
+      'PRIMARY KEY (dir_id, base_name))')
+  # Rows are copied in key order, so that both the table and its primary
+  # key index are written sequentially.
+  cursor.execute(
+      'INSERT INTO file_stats_v2 (dir_id, base_name, md5hash, size, '
+      'timestamp_seconds, algorithm, partial_hash, device, inode, mtime_ns) '
+      'SELECT d.dir_id, f.base_name, unhex(f.md5hash), f.size, '
+      'f.timestamp_seconds, f.algorithm, unhex(f.partial_hash), f.device, '
+      'f.inode, f.mtime_ns FROM file_stats f JOIN dirs d ON d.path=f.path '
+      'ORDER BY d.dir_id, f.base_name')
+  cursor.execute('DROP TABLE file_stats')
+  cursor.execute('ALTER TABLE file_stats_v2 RENAME TO file_stats')
+  cursor.execute(
+      'CREATE INDEX file_stats_hash_size ON file_stats (md5hash, size)')
+  cursor.execute(
+      'CREATE INDEX file_stats_inode ON file_stats (inode, device)')
+  cursor.execute(
+      'CREATE TABLE chunks_v2 (file_hash blob, algorithm text, '
+      'chunk_offset integer, length integer, chunk_hash blob, '
+      'PRIMARY KEY (file_hash, algorithm, chunk_offset))')
+  cursor.execute(
+      'INSERT OR IGNORE INTO chunks_v2 (file_hash, algorithm, chunk_offset, '
+      'length, chunk_hash) SELECT unhex(file_hash), algorithm, chunk_offset, '
+      'length, unhex(chunk_hash) FROM chunks '
+      'WHERE unhex(file_hash) IS NOT NULL '
+      'ORDER BY file_hash, algorithm, chunk_offset')
+  cursor.execute('DROP TABLE chunks')
+  cursor.execute('ALTER TABLE chunks_v2 RENAME TO chunks')
+  cursor.execute('CREATE INDEX chunks_chunk_hash ON chunks (chunk_hash)')
+  CreateDirectoryPathIndex(cursor)
+
+
+class HashFilter(object):
+  """A Bloom filter over the (hash, size) of the files of a catalog, to
+  skip the database query of a lookup that has no match. MayContain never
+  misses a (hash, size) that was added, and says yes for others with a
+  probability of about 1% while no more than capacity keys were added.
+  Keys cannot be removed, which only adds false positives.
+
+  The bit indexes are derived from the md5 of the digest and the size, so
+  that digests of every length (see HASH_ALGORITHMS) give two independent
+  64-bit values. generation is the value of the catalog generation (see
+  FileStatsRepository.Flush) that the filter reflects, so that a stale
+  side file is detected.
+  """
+  HEADER = struct.Struct('<8sIQQIQ')
+  MAGIC = 'dupes2bf'
+  VERSION = 2
+  BITS_PER_KEY = 10
+  HASH_COUNT = 7
+  KEY = struct.Struct('<QQ')
+
+  def __init__(self, capacity, generation=0, bits=None, count=0):
+    self.capacity = capacity
+    self.bit_count = max(capacity * self.BITS_PER_KEY, 64)
+    self.generation = generation
+    self.count = count
+    if bits is None:
+      bits = bytearray((self.bit_count + 7) / 8)
+    self.bits = bits
+
+  def Indexes(self, md5hash, size):
+    """Yields the bit indexes of a key (double hashing)."""
+    index, step = self.KEY.unpack(hashlib.md5(
+        '%s %d' % (md5hash, size)).digest())
+    index %= self.bit_count
+    step = (step | 1) % self.bit_count
+    for i in xrange(self.HASH_COUNT):
+      yield index
+      index = (index + step) % self.bit_count
+
+  def Add(self, md5hash, size):
+    bits = self.bits
+    for index in self.Indexes(md5hash, size):
+      bits[index >> 3] |= 1 << (index & 7)
+    self.count += 1
+
+  def MayContain(self, md5hash, size):
+    bits = self.bits
+    # Most absent keys are ruled out by the first indexes.
+    for index in self.Indexes(md5hash, size):
+      if not bits[index >> 3] & (1 << (index & 7)):
+        return False
+    return True
+
+  def IsFull(self):
+    return self.count > self.capacity
+
+  def Save(self, filename):
+    """Writes the filter to filename, atomically."""
+    temporary = filename + '.tmp'
+    f = open(temporary, 'wb')
+    try:
+      f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.capacity,
+                               self.count, self.HASH_COUNT, self.generation))
+      f.write(self.bits)
+    finally:
+      f.close()
+    os.rename(temporary, filename)
+
+
+def LoadHashFilter(filename):
+  """Returns the HashFilter saved in filename, or None if there is none or
+  it is not readable."""
+  try:
+    f = open(filename, 'rb')
+  except IOError:
+    return None
+  try:
+    header = f.read(HashFilter.HEADER.size)
+    if len(header) < HashFilter.HEADER.size:
+      return None
+    magic, version, capacity, count, hash_count, generation = (
+        HashFilter.HEADER.unpack(header))
+    if (magic != HashFilter.MAGIC or version != HashFilter.VERSION
+        or hash_count != HashFilter.HASH_COUNT):
+      return None
+    hash_filter = HashFilter(capacity, generation, count=count)
+    bits = bytearray(f.read())
+    if len(bits) != len(hash_filter.bits):
+      return None
+    hash_filter.bits = bits
+    return hash_filter
+  finally:
+    f.close()
+
+
+# Schema upgrades, applied in order. PRAGMA user_version holds the number of
+# upgrades already applied to a database. An upgrade is either a list of
+# statements or a function of a cursor.
+SCHEMA_UPGRADES = [
+  # Catalogs written before the algorithm was configurable only hold md5.
+  ["ALTER TABLE file_stats ADD COLUMN algorithm text NOT NULL DEFAULT 'md5'"],
+  # Rows written by --find_duplicates may only have a partial hash, in which
+  # case md5hash is NULL.
+  ['ALTER TABLE file_stats ADD COLUMN partial_hash text'],
+  ['CREATE INDEX IF NOT EXISTS file_stats_hash_size '
+   'ON file_stats (md5hash, size)'],
+  CreatePathIndex,
+  # State of each directory when all of its files were last hashed.
+  ['CREATE TABLE IF NOT EXISTS directories (path text PRIMARY KEY, '
+   'mtime_ns integer, entry_count integer, algorithm text)'],
+  # Identity of the file when it was hashed, to find hard links and renamed
+  # files. NULL for rows written before.
+  ['ALTER TABLE file_stats ADD COLUMN device integer',
+   'ALTER TABLE file_stats ADD COLUMN inode integer',
+   'ALTER TABLE file_stats ADD COLUMN mtime_ns integer',
+   'CREATE INDEX IF NOT EXISTS file_stats_inode '
+   'ON file_stats (inode, device)'],
+  # Content-defined chunks of large files, per distinct content (see
+  # ChunkFile).
+  ['CREATE TABLE IF NOT EXISTS chunks (file_hash text, algorithm text, '
+   'chunk_offset integer, length integer, chunk_hash text, '
+   'PRIMARY KEY (file_hash, algorithm, chunk_offset))',
+   'CREATE INDEX IF NOT EXISTS chunks_chunk_hash ON chunks (chunk_hash)'],
+  MigrateToDirectoryIds,
+  # generation is incremented by every write of file rows, see HashFilter.
+  ['CREATE TABLE IF NOT EXISTS catalog_state (name text PRIMARY KEY, '
+   'value integer)',
+   "INSERT OR IGNORE INTO catalog_state VALUES ('generation', 0)"],
+  # Position of each --hash_to_database run that did not finish, see
+  # ScanCheckpoint.
+  ['CREATE TABLE IF NOT EXISTS checkpoints (roots text PRIMARY KEY, '
+   'algorithm text, full integer, root_index integer, cursor text, '
+   'files integer, directories integer, timestamp_seconds integer)'],
 ]
 
+# The columns of a FileStats, in the order of its constructor, selected from
+# FILE_STATS_TABLES.
+FILE_STATS_COLUMNS = [
+  'd.path', 'f.base_name', 'f.md5hash', 'f.size', 'f.timestamp_seconds',
+  'f.algorithm', 'f.partial_hash', 'f.device', 'f.inode', 'f.mtime_ns']
+FILE_STATS_TABLES = 'file_stats f JOIN dirs d ON d.dir_id=f.dir_id'
+
+# Number of dir_id of directory paths kept in memory when writing.
+DIR_ID_CACHE_SIZE = 100000
+
+def DigestToBlob(digest):
+  """Returns the BLOB under which a hex digest is stored, or None for
+  None."""
+  if digest is None:
+    return None
+  return buffer(binascii.unhexlify(digest))
+
+def BlobToDigest(blob):
+  """The reverse of DigestToBlob."""
+  if blob is None:
+    return None
+  return binascii.hexlify(blob)
+
+def Unhex(digest):
+  """The unhex SQL function of the schema upgrade to BLOB digests: like
+  DigestToBlob, but returns None for invalid digests."""
+  try:
+    return DigestToBlob(digest)
+  except (TypeError, binascii.Error):
+    return None
+
+def MtimeNs(stat):
+  """Returns the modification time of an os.stat result in nanoseconds."""
+  if hasattr(stat, 'st_mtime_ns'):
+    return stat.st_mtime_ns
+  return int(stat.st_mtime * 1000000000)
+
+
 def GetConsoleWidth():
   tokens = os.popen('stty size', 'r').read().split()
   if len(tokens) < 2:
@@ -24,61 +411,285 @@ def GetConsoleWidth():
   return int(tokens[1])
 
 
+def ConsoleOutput(args):
+  """Returns the stream of the console: stderr when a report or an export
+  is written to stdout ('-'), so that it is not mixed with them."""
+  outputs = (args.report_duplicates, args.report_shared_chunks, args.export,
+             args.merged_export, args.report_cross_host)
+  if '-' in outputs:
+    return sys.stderr
+  return sys.stdout
+
+
 class InteractiveConsole(object):
-  def __init__(self):
+  def __init__(self, output=sys.stdout):
+    self.output = output
     self.last_refresh_time = time.time()
+    self.metrics = None
+    # Cached, since GetConsoleWidth runs a process. Reset on SIGWINCH.
+    self.width = None
+    try:
+      signal.signal(signal.SIGWINCH, self.OnResize)
+      # Restart the system calls that the signal interrupts, rather than
+      # failing them with EINTR.
+      signal.siginterrupt(signal.SIGWINCH, False)
+    except ValueError:
+      pass  # Not the main thread.
+
+  def OnResize(self, signum, frame):
+    self.width = None
+
+  def SetMetrics(self, metrics):
+    """Shows the ScanMetrics in front of each Flash, or stops if None."""
+    self.metrics = metrics
 
   def Print(self, s=''):
-    print '\033[K%s' % s
-    sys.stdout.flush()
+    print >>self.output, '\033[K%s' % s
+    self.output.flush()
     self.last_refresh_time = time.time()
 
   def Error(self, s):
-    print '\033[K\033[91m%s\033[0m' % s
-    sys.stdout.flush()
+    print >>self.output, '\033[K\033[91m%s\033[0m' % s
+    self.output.flush()
     self.last_refresh_time = time.time()
 
   def Flash(self, s):
     now = time.time()
     if now < self.last_refresh_time + 1:
       return
-    width = GetConsoleWidth()
+    if self.width is None:
+      self.width = GetConsoleWidth() or 80
+    width = self.width
+    if self.metrics:
+      prefix = self.metrics.Format() + ' | '
+      width = max(width - len(prefix), 20)
     if len(s) > width:
       b1 = width / 2 - 1
       b2 = b1 + 3 + len(s) - width
       s = s[:b1] + '...' + s[b2:]
-    print '\033[K%s\r' % s,
-    sys.stdout.flush()
+    if self.metrics:
+      s = prefix + s
+    print >>self.output, '\033[K%s\r' % s,
+    self.output.flush()
     self.last_refresh_time = now
 
 
 class RedirectedConsole(object):
-  def __init__(self):
+  def __init__(self, output=sys.stdout):
+    self.output = output
     self.last_refresh_time = time.time()
+    self.metrics = None
+
+  def SetMetrics(self, metrics):
+    """Logs the ScanMetrics with each Flash, or stops if None."""
+    self.metrics = metrics
 
   def Print(self, s=''):
-    print '<info> %s' % s
+    print >>self.output, '<info> %s' % s
     self.last_refresh_time = time.time()
 
   def Error(self, s):
-    print '<error> %s' % s
+    print >>self.output, '<error> %s' % s
     self.last_refresh_time = time.time()
 
   def Flash(self, s):
     now = time.time()
     if now < self.last_refresh_time + 1:
       return
-    print '%s' % s
+    if self.metrics:
+      print >>self.output, '<progress> %s %s' % (
+          self.metrics.FormatFields(), s)
+    else:
+      print >>self.output, '%s' % s
     self.last_refresh_time = now
 
 
+class ScanMetrics(object):
+  """Throughput of a scan: files per second, MB per second of hashed data,
+  the ratio of files whose hash came from the database (cache hits), and an
+  ETA from the number of files that the database holds for the scanned
+  paths. Files of unchanged directories that are skipped are not counted, so
+  the ETA is an upper bound for incremental scans.
+
+  With an output file, the metrics are also written to it as one JSON object
+  per line, every interval seconds and when the scan ends.
+  """
+
+  def __init__(self, name, expected_files=0, output=None, interval=10):
+    self.name = name
+    self.expected_files = expected_files
+    self.output = output
+    self.interval = interval
+    self.start_time = time.time()
+    self.last_write_time = self.start_time
+    self.cached_files = 0
+    self.hashed_files = 0
+    self.hashed_bytes = 0
+
+  def FileCached(self):
+    self.cached_files += 1
+    self.WriteIfDue()
+
+  def FileHashed(self, size):
+    self.hashed_files += 1
+    self.hashed_bytes += size
+    self.WriteIfDue()
+
+  def Get(self):
+    """Returns the metrics as a dict."""
+    now = time.time()
+    elapsed = max(now - self.start_time, 1e-6)
+    files = self.cached_files + self.hashed_files
+    files_per_second = files / elapsed
+    eta_seconds = None
+    if self.expected_files and files_per_second:
+      eta_seconds = max(self.expected_files - files, 0) / files_per_second
+    hit_ratio = None
+    if files:
+      hit_ratio = float(self.cached_files) / files
+    return collections.OrderedDict([
+        ('name', self.name),
+        ('time', now),
+        ('elapsed_seconds', elapsed),
+        ('files', files),
+        ('cached_files', self.cached_files),
+        ('hashed_files', self.hashed_files),
+        ('hashed_bytes', self.hashed_bytes),
+        ('files_per_second', files_per_second),
+        ('mb_per_second', self.hashed_bytes / elapsed / (1 << 20)),
+        ('hit_ratio', hit_ratio),
+        ('expected_files', self.expected_files),
+        ('eta_seconds', eta_seconds),
+    ])
+
+  def Format(self):
+    """Returns the metrics in a short form, for a status line."""
+    metrics = self.Get()
+    s = '%d files, %.0f files/s, %.1f MB/s' % (
+        metrics['files'], metrics['files_per_second'],
+        metrics['mb_per_second'])
+    if metrics['hit_ratio'] is not None:
+      s += ', %.0f%% cached' % (100 * metrics['hit_ratio'])
+    if metrics['eta_seconds'] is not None:
+      s += ', ETA %s' % timedelta(seconds=int(metrics['eta_seconds']))
+    return s
+
+  def FormatFields(self):
+    """Returns the metrics as key=value fields, for logs."""
+    fields = []
+    for key, value in self.Get().iteritems():
+      if key == 'time':
+        continue
+      if isinstance(value, float):
+        value = '%.3f' % value
+      fields.append('%s=%s' % (key, value))
+    return ' '.join(fields)
+
+  def WriteIfDue(self):
+    if self.output and time.time() >= self.last_write_time + self.interval:
+      self.Write()
+
+  def Write(self, done=False):
+    self.last_write_time = time.time()
+    if not self.output:
+      return
+    metrics = self.Get()
+    metrics['done'] = done
+    self.output.write(json.dumps(metrics) + '\n')
+    self.output.flush()
+
+
+class LatencyHistogram(object):
+  """Counts durations in logarithmic buckets, BUCKETS_PER_OCTAVE per power
+  of 2, so that percentiles are estimated within 10% in constant memory."""
+  BUCKETS_PER_OCTAVE = 8
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.buckets = {}
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def Add(self, seconds):
+    bucket = int(math.floor(
+        math.log(max(seconds, 1e-9), 2) * self.BUCKETS_PER_OCTAVE))
+    with self.lock:
+      self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+      self.count += 1
+      self.total += seconds
+      self.max = max(self.max, seconds)
+
+  def Percentile(self, percent):
+    """Returns the upper bound of the bucket of the given percentile."""
+    rank = self.count * percent / 100.0
+    seen = 0
+    for bucket in sorted(self.buckets):
+      seen += self.buckets[bucket]
+      if seen >= rank:
+        return min(2 ** (float(bucket + 1) / self.BUCKETS_PER_OCTAVE),
+                   self.max)
+    return self.max
+
+
+class PhaseProfiler(object):
+  """Times the calls of instrumented functions, per phase, for --profile.
+
+  Instrument replaces a function or method by a wrapper that records the
+  duration of each call in the LatencyHistogram of its phase, from any
+  thread. Nothing is wrapped unless --profile is given, so the
+  instrumentation costs nothing otherwise.
+  """
+
+  def __init__(self):
+    # Phase name -> LatencyHistogram, in the order of instrumentation.
+    self.phases = collections.OrderedDict()
+
+  def Instrument(self, owner, attribute, phase):
+    """Times the calls of owner.attribute, a module function or the method
+    of an object, under the given phase."""
+    function = getattr(owner, attribute)
+    histogram = self.phases.setdefault(phase, LatencyHistogram())
+
+    def Timed(*args, **kwargs):
+      start = time.time()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        histogram.Add(time.time() - start)
+    setattr(owner, attribute, Timed)
+
+  def Report(self, console):
+    """Prints the count, total and latencies of each phase."""
+    console.Print('%-22s %9s %10s %9s %9s %9s %9s' % (
+        'phase', 'count', 'total s', 'mean ms', 'p50 ms', 'p99 ms', 'max ms'))
+    for phase, histogram in self.phases.iteritems():
+      if not histogram.count:
+        continue
+      console.Print('%-22s %9d %10.3f %9.3f %9.3f %9.3f %9.3f' % (
+          phase, histogram.count, histogram.total,
+          1000 * histogram.total / histogram.count,
+          1000 * histogram.Percentile(50), 1000 * histogram.Percentile(99),
+          1000 * histogram.max))
+
+
 class FileStats(object):
-  def __init__(self, path, base_name, md5hash, size, timestamp_seconds):
+  __slots__ = ('path', 'base_name', 'md5hash', 'size', 'timestamp_seconds',
+               'algorithm', 'partial_hash', 'device', 'inode', 'mtime_ns')
+
+  def __init__(self, path, base_name, md5hash, size, timestamp_seconds,
+               algorithm='md5', partial_hash=None, device=None, inode=None,
+               mtime_ns=None):
     self.path = path
     self.base_name = base_name
     self.md5hash = md5hash
     self.size = size
     self.timestamp_seconds = timestamp_seconds
+    self.algorithm = algorithm
+    self.partial_hash = partial_hash
+    self.device = device
+    self.inode = inode
+    self.mtime_ns = mtime_ns
 
   def GetPath(self):
     return self.path
@@ -95,22 +706,169 @@ class FileStats(object):
   def GetTimestampSeconds(self):
     return self.timestamp_seconds
 
+  def GetAlgorithm(self):
+    return self.algorithm
+
+  def GetPartialHash(self):
+    return self.partial_hash
+
+  def GetDevice(self):
+    return self.device
+
+  def GetInode(self):
+    return self.inode
+
+  def GetMtimeNs(self):
+    return self.mtime_ns
+
   def __str__(self):
-    return '%s %s %s %s %s' % (
+    return '%s %s %s %s %s %s %s' % (
         self.GetPath(),
         self.GetBaseName(),
         self.GetHash(),
         self.GetSize(),
-        self.GetTimestampSeconds())
+        self.GetTimestampSeconds(),
+        self.GetAlgorithm(),
+        self.GetPartialHash())
+
+
+class DirectoryStats(object):
+  __slots__ = ('path', 'mtime_ns', 'entry_count', 'algorithm')
+
+  def __init__(self, path, mtime_ns, entry_count, algorithm):
+    self.path = path
+    self.mtime_ns = mtime_ns
+    self.entry_count = entry_count
+    self.algorithm = algorithm
+
+  def GetPath(self):
+    return self.path
+
+  def GetMtimeNs(self):
+    return self.mtime_ns
+
+  def GetEntryCount(self):
+    return self.entry_count
+
+  def GetAlgorithm(self):
+    return self.algorithm
+
+
+class ScanCheckpoint(object):
+  """Position of a --hash_to_database run over roots, a list of absolute
+  paths. cursor is the last directory, in walk order (see WalkKey), such
+  that it and every directory walked before it in the root at root_index
+  are done; None until the first one is. files and directories count what
+  was done, over all the runs that resumed from one another."""
+
+  __slots__ = ('roots', 'algorithm', 'full', 'root_index', 'cursor', 'files',
+               'directories', 'timestamp_seconds')
+
+  def __init__(self, roots, algorithm, full, root_index=0, cursor=None,
+               files=0, directories=0, timestamp_seconds=None):
+    self.roots = roots
+    self.algorithm = algorithm
+    self.full = full
+    self.root_index = root_index
+    self.cursor = cursor
+    self.files = files
+    self.directories = directories
+    if timestamp_seconds is None:
+      timestamp_seconds = int(time.time())
+    self.timestamp_seconds = timestamp_seconds
+
+  def GetRoots(self):
+    return self.roots
+
+  def GetAlgorithm(self):
+    return self.algorithm
+
+  def IsFull(self):
+    return self.full
+
+  def GetRootIndex(self):
+    return self.root_index
+
+  def GetCursor(self):
+    return self.cursor
+
+  def GetFiles(self):
+    return self.files
+
+  def GetDirectories(self):
+    return self.directories
+
+  def GetTimestampSeconds(self):
+    return self.timestamp_seconds
 
 
 class FileStatsRepository(object):
+  """Stores FileStats in a sqlite database.
+
+  Upserts are buffered and written with executemany in one transaction per
+  batch, once batch_size rows are pending or batch_seconds have passed since
+  the previous write. A crash loses at most the pending batch. With
+  batch_size=1, every row is committed on its own.
+
+  Get loads all the rows of a directory with one query and keeps them for
+  the directory_cache_size most recently used directories, so that a walk,
+  which visits files directory by directory, costs one query per directory.
+
+  Rows refer to their directory by a dir_id into the dirs table and hold
+  digests as BLOBs (see MigrateToDirectoryIds); FileStats hold the directory
+  path and hex digests, and the conversion happens here.
+
+  MayContain answers from a HashFilter kept in a side file next to the
+  database. It is built from the database on first use, then updated with
+  each upsert and saved by Close. A side file that missed writes is rebuilt.
 
-  def __init__(self, database_filename):
+  A ScanCheckpoint given to SetCheckpoint is written with the next batch, so
+  that it never gets ahead of the rows upserted before it.
+  """
+
+  def __init__(self, database_filename, batch_size=1000, batch_seconds=5,
+               synchronous='NORMAL', cache_size=-65536,
+               directory_cache_size=64):
     directory, base_name = os.path.split(database_filename)
     if not os.path.exists(directory):
       os.makedirs(directory)
-    self.connection = sqlite3.connect(database_filename)
+    self.database_filename = database_filename
+    # Transactions are managed explicitly with BEGIN / COMMIT.
+    self.connection = sqlite3.connect(database_filename, isolation_level=None)
+    # sqlite >= 3.41 has its own, which does not accept invalid digests.
+    self.connection.create_function('unhex', 1, Unhex)
+    cursor = self.connection.cursor()
+    # Only takes effect on a new database; see Vacuum for existing ones.
+    cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=%s' % synchronous)
+    cursor.execute('PRAGMA cache_size=%d' % cache_size)
+    cursor.execute('PRAGMA recursive_triggers=ON')
+    self.batch_size = batch_size
+    self.batch_seconds = batch_seconds
+    self.last_flush_time = time.time()
+    # (path, base_name) -> FileStats not yet written to the database.
+    self.pending = {}
+    # path -> DirectoryStats not yet written to the database.
+    self.pending_directories = {}
+    # (path, base_name) of rows to delete.
+    self.pending_deletes = set()
+    # (device, inode) -> the last pending FileStats with that identity.
+    self.pending_inodes = {}
+    # roots -> ScanCheckpoint to write, or None to delete.
+    self.pending_checkpoints = {}
+    self.directory_cache_size = directory_cache_size
+    # path -> {base_name: FileStats}, least recently used first.
+    self.directory_cache = collections.OrderedDict()
+    self.most_recent_directory = None
+    # Directory path -> dir_id, for writes.
+    self.dir_ids = {}
+    # The HashFilter, once used or if the side file exists.
+    self.hash_filter = None
+    self.hash_filter_modified = False
+    # Whether Flush found the side file stale; MayContain rebuilds it.
+    self.hash_filter_stale = False
+    self.data_version = None
 
   def CreateTable(self):
     cursor = self.connection.cursor()
@@ -118,107 +876,1333 @@ class FileStatsRepository(object):
         'CREATE TABLE IF NOT EXISTS file_stats (path text, base_name text, '
         'md5hash text, size integer, timestamp_seconds integer, '
         'PRIMARY KEY (path, base_name))')
-    self.connection.commit()
+    self.UpgradeSchema()
+
+  def UpgradeSchema(self):
+    cursor = self.connection.cursor()
+    cursor.execute('BEGIN')
+    cursor.execute('PRAGMA user_version')
+    version = cursor.fetchone()[0]
+    for upgrade in SCHEMA_UPGRADES[version:]:
+      if callable(upgrade):
+        upgrade(cursor)
+      else:
+        for statement in upgrade:
+          cursor.execute(statement)
+      version += 1
+      cursor.execute('PRAGMA user_version = %d' % version)
+    cursor.execute('COMMIT')
+    cursor.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE name='file_paths'")
+    self.has_path_index = cursor.fetchone()[0] > 0
 
   def Close(self):
+    self.Flush()
+    if (self.hash_filter and self.hash_filter_modified
+        and self.hash_filter.generation is not None):
+      self.hash_filter.Save(self.GetHashFilterFilename())
     self.connection.close()
 
+  def GetHashFilterFilename(self):
+    return self.database_filename + '.bloom'
+
+  def GetGeneration(self):
+    cursor = self.connection.cursor()
+    cursor.execute("SELECT value FROM catalog_state WHERE name='generation'")
+    return cursor.fetchone()[0]
+
+  def LoadHashFilter(self, create):
+    """Loads the side file into hash_filter, if it exists and is current;
+    otherwise builds the filter from the database if create is set (or if
+    the side file exists)."""
+    filename = self.GetHashFilterFilename()
+    exists = os.path.exists(filename)
+    if not exists and not create:
+      return
+    self.Flush()
+    if self.hash_filter:
+      return  # Loaded by Flush.
+    cursor = self.connection.cursor()
+    cursor.execute('PRAGMA data_version')
+    self.data_version = cursor.fetchone()[0]
+    generation = self.GetGeneration()
+    hash_filter = None
+    if exists and not self.hash_filter_stale:
+      hash_filter = LoadHashFilter(filename)
+    if (hash_filter and hash_filter.generation == generation
+        and not hash_filter.IsFull()):
+      self.hash_filter = hash_filter
+      self.hash_filter_modified = False
+      return
+    self.RebuildHashFilter()
+
+  def RebuildHashFilter(self):
+    """Builds hash_filter from the (hash, size) index of the database, with
+    room for twice as many rows."""
+    self.Flush()
+    cursor = self.connection.cursor()
+    cursor.execute('BEGIN')
+    try:
+      generation = self.GetGeneration()
+      cursor.execute(
+          'SELECT COUNT(*) FROM file_stats WHERE md5hash IS NOT NULL')
+      hash_filter = HashFilter(
+          max(2 * cursor.fetchone()[0], 65536), generation)
+      cursor.execute(
+          'SELECT md5hash, size FROM file_stats WHERE md5hash IS NOT NULL')
+      for md5hash, size in cursor:
+        hash_filter.Add(BlobToDigest(md5hash), size)
+    finally:
+      cursor.execute('COMMIT')
+    self.hash_filter = hash_filter
+    self.hash_filter_modified = True
+    self.hash_filter_stale = False
+
+  def MayContain(self, md5hash, size):
+    """Returns False if no file of the database, including pending ones, has
+    the given hash and size, and True if one may have (see HashFilter)."""
+    if self.hash_filter is None:
+      self.LoadHashFilter(True)
+    else:
+      # data_version only changes when another connection writes.
+      cursor = self.connection.cursor()
+      cursor.execute('PRAGMA data_version')
+      data_version = cursor.fetchone()[0]
+      if data_version != self.data_version:
+        self.data_version = data_version
+        if self.GetGeneration() != self.hash_filter.generation:
+          self.hash_filter.generation = None
+      if self.hash_filter.generation is None or self.hash_filter.IsFull():
+        self.RebuildHashFilter()
+    return self.hash_filter.MayContain(md5hash, size)
+
   def Upsert(self, file_stats):
+    key = (file_stats.GetPath(), file_stats.GetBaseName())
+    self.pending[key] = file_stats
+    self.pending_deletes.discard(key)
+    if file_stats.GetInode() is not None:
+      self.pending_inodes[
+          (file_stats.GetDevice(), file_stats.GetInode())] = file_stats
+    if key[0] in self.directory_cache:
+      self.directory_cache[key[0]][key[1]] = file_stats
+    if self.hash_filter and file_stats.GetHash():
+      self.hash_filter.Add(file_stats.GetHash(), file_stats.GetSize())
+      self.hash_filter_modified = True
+    self.FlushIfDue()
+
+  def Delete(self, path, base_name):
+    key = (path, base_name)
+    self.pending.pop(key, None)
+    self.pending_deletes.add(key)
+    if path in self.directory_cache:
+      self.directory_cache[path].pop(base_name, None)
+    self.FlushIfDue()
+
+  def ForgetTree(self, path):
+    """Drops what is cached about the directories at or below path."""
+    prefix = path
+    if not prefix.endswith('/'):
+      prefix += '/'
+    directory, base_name = os.path.split(path)
+    for cached_path in self.directory_cache.keys():
+      if cached_path == path or cached_path.startswith(prefix):
+        del self.directory_cache[cached_path]
+    self.most_recent_directory = None
+    if directory in self.directory_cache:
+      self.directory_cache[directory].pop(base_name, None)
+    for cached_path in self.dir_ids.keys():
+      if cached_path == path or cached_path.startswith(prefix):
+        del self.dir_ids[cached_path]
+    return prefix
+
+  def DeleteTree(self, path):
+    """Deletes the files and directories at or below path, immediately."""
+    self.Flush()
+    prefix = self.ForgetTree(path)
+    directory, base_name = os.path.split(path)
+    cursor = self.connection.cursor()
+    cursor.execute('BEGIN')
+    cursor.execute(
+        'DELETE FROM file_stats WHERE dir_id IN (SELECT dir_id FROM dirs '
+        'WHERE path=? OR (path>=? AND path<?))',
+        (path, prefix, prefix[:-1] + '0'))
+    cursor.execute(
+        'DELETE FROM file_stats WHERE dir_id=(SELECT dir_id FROM dirs '
+        'WHERE path=?) AND base_name=?', (directory, base_name))
+    cursor.execute(
+        'DELETE FROM dirs WHERE path=? OR (path>=? AND path<?)',
+        (path, prefix, prefix[:-1] + '0'))
+    cursor.execute(
+        'DELETE FROM directories WHERE path=? OR (path>=? AND path<?)',
+        (path, prefix, prefix[:-1] + '0'))
+    cursor.execute('COMMIT')
+
+  def MoveTree(self, path, new_path):
+    """Moves the files and directories at or below path to new_path,
+    immediately, in place of those that were at or below new_path. Only
+    the paths of dirs change, so the rows keep their hashes."""
+    self.DeleteTree(new_path)
+    prefix = self.ForgetTree(path)
+    new_prefix = new_path.rstrip('/') + '/'
+    cursor = self.connection.cursor()
+    cursor.execute('BEGIN')
+    try:
+      for table in ('dirs', 'directories'):
+        # substr counts characters, as len of a unicode path does.
+        cursor.execute(
+            'UPDATE %s SET path=? || substr(path, ?) '
+            'WHERE path=? OR (path>=? AND path<?)' % table,
+            (new_path, len(path) + 1, path, prefix, prefix[:-1] + '0'))
+      if self.has_path_index:
+        # Its triggers only follow file_stats.
+        cursor.execute(
+            "UPDATE file_paths SET full_path=(SELECT d.path || '/' || "
+            'f.base_name FROM %s WHERE f.rowid=file_paths.rowid) '
+            'WHERE rowid IN (SELECT f.rowid FROM %s '
+            'WHERE d.path=? OR (d.path>=? AND d.path<?))' % (
+                FILE_STATS_TABLES, FILE_STATS_TABLES),
+            (new_path, new_prefix, new_prefix[:-1] + '0'))
+    except:
+      cursor.execute('ROLLBACK')
+      raise
+    cursor.execute('COMMIT')
+
+  def UpsertDirectory(self, directory_stats):
+    self.pending_directories[directory_stats.GetPath()] = directory_stats
+    self.FlushIfDue()
+
+  def FlushIfDue(self):
+    pending_count = (len(self.pending) + len(self.pending_directories)
+                     + len(self.pending_deletes))
+    if (pending_count >= self.batch_size
+        or time.time() >= self.last_flush_time + self.batch_seconds):
+      self.Flush()
+
+  def Flush(self):
+    """Writes all pending upserts and deletes in a single transaction."""
+    self.last_flush_time = time.time()
+    if (not self.pending and not self.pending_directories
+        and not self.pending_deletes and not self.pending_checkpoints):
+      return
+    if (self.pending and self.hash_filter is None
+        and not self.hash_filter_stale):
+      # Keeps an existing side file current.
+      filename = self.GetHashFilterFilename()
+      if os.path.exists(filename):
+        hash_filter = LoadHashFilter(filename)
+        if hash_filter and hash_filter.generation == self.GetGeneration():
+          self.hash_filter = hash_filter
+          for file_stats in self.pending.itervalues():
+            if file_stats.GetHash():
+              hash_filter.Add(file_stats.GetHash(), file_stats.GetSize())
+          self.hash_filter_modified = True
+        else:
+          # Not read again by the next batches.
+          self.hash_filter_stale = True
+    cursor = self.connection.cursor()
+    cursor.execute('BEGIN')
+    try:
+      if self.pending:
+        generation = self.GetGeneration()
+        cursor.execute("UPDATE catalog_state SET value=value+1 "
+                       "WHERE name='generation'")
+        if self.hash_filter:
+          if self.hash_filter.generation == generation:
+            self.hash_filter.generation = generation + 1
+          else:
+            # Another connection wrote rows that the filter lacks.
+            self.hash_filter.generation = None
+      cursor.executemany(
+          'DELETE FROM file_stats WHERE dir_id=(SELECT dir_id FROM dirs '
+          'WHERE path=?) AND base_name=?',
+          self.pending_deletes)
+      cursor.executemany(
+          'INSERT OR REPLACE INTO file_stats (dir_id, base_name, md5hash, '
+          'size, timestamp_seconds, algorithm, partial_hash, device, inode, '
+          'mtime_ns) VALUES (?,?,?,?,?,?,?,?,?,?)',
+          [(self.GetDirId(cursor, file_stats.GetPath()),
+            file_stats.GetBaseName(),
+            DigestToBlob(file_stats.GetHash()),
+            file_stats.GetSize(),
+            file_stats.GetTimestampSeconds(),
+            file_stats.GetAlgorithm(),
+            DigestToBlob(file_stats.GetPartialHash()),
+            file_stats.GetDevice(),
+            file_stats.GetInode(),
+            file_stats.GetMtimeNs())
+           for file_stats in self.pending.itervalues()])
+      cursor.executemany(
+          'INSERT OR REPLACE INTO directories '
+          '(path, mtime_ns, entry_count, algorithm) VALUES (?,?,?,?)',
+          [(directory_stats.GetPath(),
+            directory_stats.GetMtimeNs(),
+            directory_stats.GetEntryCount(),
+            directory_stats.GetAlgorithm())
+           for directory_stats in self.pending_directories.itervalues()])
+      for roots, checkpoint in self.pending_checkpoints.iteritems():
+        if checkpoint is None:
+          cursor.execute('DELETE FROM checkpoints WHERE roots=?', (roots,))
+          continue
+        cursor.execute(
+            'INSERT OR REPLACE INTO checkpoints (roots, algorithm, full, '
+            'root_index, cursor, files, directories, timestamp_seconds) '
+            'VALUES (?,?,?,?,?,?,?,?)',
+            (roots, checkpoint.GetAlgorithm(), int(checkpoint.IsFull()),
+             checkpoint.GetRootIndex(), checkpoint.GetCursor(),
+             checkpoint.GetFiles(), checkpoint.GetDirectories(),
+             checkpoint.GetTimestampSeconds()))
+    except:
+      cursor.execute('ROLLBACK')
+      # Some of them may have been added by the transaction.
+      self.dir_ids = {}
+      raise
+    cursor.execute('COMMIT')
+    self.pending = {}
+    self.pending_directories = {}
+    self.pending_deletes = set()
+    self.pending_inodes = {}
+    self.pending_checkpoints = {}
+
+  def GetDirId(self, cursor, path):
+    """Returns the dir_id of a directory path, adding the directory to dirs
+    if needed. Only called within a transaction."""
+    dir_id = self.dir_ids.get(path)
+    if dir_id is None:
+      cursor.execute('INSERT OR IGNORE INTO dirs (path) VALUES (?)', (path,))
+      cursor.execute('SELECT dir_id FROM dirs WHERE path=?', (path,))
+      dir_id = cursor.fetchone()[0]
+      if len(self.dir_ids) >= DIR_ID_CACHE_SIZE:
+        self.dir_ids = {}
+      self.dir_ids[path] = dir_id
+    return dir_id
+
+  def GetFileKeysAfter(self, path, base_name, limit):
+    """Returns up to limit (path, base_name) of file_stats that follow the
+    given one, in order. Each call is a separate query, so that no cursor
+    stays open while rows are deleted."""
+    self.Flush()
+    cursor = self.connection.cursor()
+    # Rather than a row value comparison, so that dirs is scanned from path.
+    cursor.execute(
+        'SELECT d.path, f.base_name FROM dirs d JOIN file_stats f '
+        'ON f.dir_id=d.dir_id WHERE d.path>=? AND (d.path>? OR f.base_name>?) '
+        'ORDER BY d.path, f.base_name LIMIT ?',
+        (path, path, base_name, limit))
+    return cursor.fetchall()
+
+  def GetDirectoryPathsAfter(self, path, limit):
+    """Like GetFileKeysAfter, for the paths of the directories table."""
+    self.Flush()
     cursor = self.connection.cursor()
     cursor.execute(
-        'INSERT OR REPLACE INTO file_stats VALUES (?,?,?,?,?)',
-        (file_stats.GetPath(),
-         file_stats.GetBaseName(),
-         file_stats.GetHash(),
-         file_stats.GetSize(),
-         file_stats.GetTimestampSeconds()))
-    self.connection.commit()
+        'SELECT path FROM directories WHERE path > ? ORDER BY path LIMIT ?',
+        (path, limit))
+    return [row[0] for row in cursor.fetchall()]
+
+  def DeleteRows(self, file_keys, directory_paths=()):
+    """Deletes the (path, base_name) files and the directories right away, in
+    a single transaction, then releases the freed pages if the database is
+    in incremental vacuum mode. The directories that are left without files
+    are removed from dirs."""
+    self.Flush()
+    paths = set(directory_paths)
+    for path, base_name in file_keys:
+      paths.add(path)
+      if path in self.directory_cache:
+        self.directory_cache[path].pop(base_name, None)
+    for path in paths:
+      self.dir_ids.pop(path, None)
+    cursor = self.connection.cursor()
+    cursor.execute('BEGIN')
+    try:
+      cursor.executemany(
+          'DELETE FROM file_stats WHERE dir_id=(SELECT dir_id FROM dirs '
+          'WHERE path=?) AND base_name=?', file_keys)
+      cursor.executemany(
+          'DELETE FROM directories WHERE path=?',
+          [(path,) for path in directory_paths])
+      cursor.executemany(
+          'DELETE FROM dirs WHERE path=? AND NOT EXISTS '
+          '(SELECT 1 FROM file_stats f WHERE f.dir_id=dirs.dir_id)',
+          [(path,) for path in paths])
+    except:
+      cursor.execute('ROLLBACK')
+      raise
+    cursor.execute('COMMIT')
+    cursor.execute('PRAGMA auto_vacuum')
+    if cursor.fetchone()[0] == 2:
+      cursor.execute('PRAGMA incremental_vacuum')
+      cursor.fetchall()
+
+  def Vacuum(self):
+    """Releases the free pages of the database. A database created before
+    incremental vacuum was enabled is converted by a full VACUUM, which
+    rewrites it once; later calls only release the free pages. The trigram
+    index keeps the entries of deleted rows until its segments are merged,
+    so it is optimized first."""
+    self.Flush()
+    cursor = self.connection.cursor()
+    if self.has_path_index:
+      cursor.execute("INSERT INTO file_paths(file_paths) VALUES('optimize')")
+    if os.path.exists(self.GetHashFilterFilename()):
+      # Drops the keys of deleted rows.
+      self.RebuildHashFilter()
+    cursor.execute('PRAGMA auto_vacuum')
+    if cursor.fetchone()[0] != 2:
+      cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+      cursor.execute('VACUUM')
+      return
+    cursor.execute('PRAGMA incremental_vacuum')
+    cursor.fetchall()
+
+  def CountFiles(self, paths):
+    """Returns the number of files in the database under the given absolute
+    paths. This is the expected number of files of a walk that is repeated
+    over the same paths."""
+    self.Flush()
+    cursor = self.connection.cursor()
+    count = 0
+    for path in paths:
+      prefix = path
+      if not prefix.endswith('/'):
+        prefix += '/'
+      # '0' is the character that follows '/'.
+      cursor.execute(
+          'SELECT COUNT(*) FROM %s '
+          'WHERE d.path=? OR (d.path>=? AND d.path<?)' % FILE_STATS_TABLES,
+          (path, prefix, prefix[:-1] + '0'))
+      count += cursor.fetchone()[0]
+      directory, base_name = os.path.split(path)
+      if self.Get(directory, base_name):
+        count += 1
+    return count
 
   def Get(self, path, base_name):
+    if (path, base_name) in self.pending:
+      return self.pending[(path, base_name)]
+    if (path, base_name) in self.pending_deletes:
+      return None
+    return self.GetDirectoryFiles(path).get(base_name)
+
+  def GetDirectoryFiles(self, path):
+    """Returns {base_name: FileStats} for the files directly in path."""
+    if path == self.most_recent_directory:
+      return self.directory_cache[path]
+    files = self.directory_cache.pop(path, None)
+    if files is None:
+      files = {}
+      for file_stats in self.SelectFileStats('d.path=?', (path,)):
+        files[file_stats.GetBaseName()] = file_stats
+      for key in self.pending_deletes:
+        if key[0] == path:
+          files.pop(key[1], None)
+      for key, file_stats in self.pending.iteritems():
+        if key[0] == path:
+          files[key[1]] = file_stats
+      if len(self.directory_cache) >= self.directory_cache_size:
+        self.directory_cache.popitem(last=False)
+    self.directory_cache[path] = files
+    self.most_recent_directory = path
+    return files
+
+  def SetCheckpoint(self, checkpoint):
+    self.pending_checkpoints[json.dumps(checkpoint.GetRoots())] = checkpoint
+
+  def DeleteCheckpoint(self, roots):
+    self.pending_checkpoints[json.dumps(roots)] = None
+
+  def GetCheckpoint(self, roots=None):
+    """Returns the ScanCheckpoint of roots, or the most recent one if roots
+    is None. Returns None if there is none."""
+    if roots is not None:
+      key = json.dumps(roots)
+      if key in self.pending_checkpoints:
+        return self.pending_checkpoints[key]
+    self.Flush()
+    cursor = self.connection.cursor()
+    columns = ('roots, algorithm, full, root_index, cursor, files, '
+               'directories, timestamp_seconds')
+    if roots is None:
+      cursor.execute('SELECT %s FROM checkpoints '
+                     'ORDER BY timestamp_seconds DESC LIMIT 1' % columns)
+    else:
+      cursor.execute('SELECT %s FROM checkpoints WHERE roots=?' % columns,
+                     (key,))
+    row = cursor.fetchone()
+    if not row:
+      return None
+    # Paths are utf8 byte strings everywhere else.
+    return ScanCheckpoint([root.encode('utf8') for root in json.loads(row[0])],
+                          row[1], bool(row[2]), row[3], row[4], *row[5:])
+
+  def GetDirectory(self, path):
+    if path in self.pending_directories:
+      return self.pending_directories[path]
     cursor = self.connection.cursor()
     cursor.execute(
-        'SELECT * FROM file_stats WHERE path=? and base_name=?',
-        (path, base_name))
+        'SELECT path, mtime_ns, entry_count, algorithm FROM directories '
+        'WHERE path=?', (path,))
     row = cursor.fetchone()
     if not row:
       return None
-    return self.MakeFileStats(row)
+    return DirectoryStats(row[0], row[1], row[2], row[3])
+
+  def Lookup(self, md5hash, size, algorithm='md5'):
+    self.Flush()
+    return self.SelectFileStats(
+        'f.md5hash=? AND f.size=? AND f.algorithm=?',
+        (DigestToBlob(md5hash), size, algorithm))
+
+  def FilesToChunk(self, min_size, algorithm='md5'):
+    """Yields (hash, list of FileStats) for each content of at least min_size
+    bytes that has no chunks yet."""
+    self.Flush()
+    files = self.SelectFileStats(
+        'f.size>=? AND f.algorithm=? AND f.md5hash IS NOT NULL '
+        'AND NOT EXISTS (SELECT 1 FROM chunks c '
+        'WHERE c.file_hash=f.md5hash AND c.algorithm=f.algorithm) '
+        'ORDER BY f.md5hash', (min_size, algorithm))
+    for md5hash, group in itertools.groupby(files, FileStats.GetHash):
+      yield md5hash, list(group)
 
-  def Lookup(self, md5hash, size):
+  def AddChunks(self, file_hash, algorithm, chunks):
+    """Stores the (offset, length, hash) chunks of a content, in one
+    transaction."""
+    cursor = self.connection.cursor()
+    cursor.execute('BEGIN')
+    try:
+      cursor.executemany(
+          'INSERT OR REPLACE INTO chunks '
+          '(file_hash, algorithm, chunk_offset, length, chunk_hash) '
+          'VALUES (?,?,?,?,?)',
+          [(DigestToBlob(file_hash), algorithm, offset, length,
+            DigestToBlob(chunk_hash))
+           for offset, length, chunk_hash in chunks])
+    except:
+      cursor.execute('ROLLBACK')
+      raise
+    cursor.execute('COMMIT')
+
+  def SharedChunkPairs(self, algorithm='md5'):
+    """Yields (hash, hash, shared bytes) for the pairs of distinct contents
+    that have chunks in common, the most shared bytes first. A chunk that
+    occurs several times in a content is counted once."""
     cursor = self.connection.cursor()
     cursor.execute(
-        'SELECT * FROM file_stats WHERE md5hash=? and size=?',
-        (md5hash, size))
+        'SELECT a.file_hash, b.file_hash, SUM(a.length) AS shared FROM '
+        '(SELECT DISTINCT file_hash, chunk_hash, length FROM chunks '
+        'WHERE algorithm=?) a JOIN '
+        '(SELECT DISTINCT file_hash, chunk_hash FROM chunks '
+        'WHERE algorithm=?) b '
+        'ON a.chunk_hash=b.chunk_hash AND a.file_hash<b.file_hash '
+        'GROUP BY a.file_hash, b.file_hash ORDER BY shared DESC',
+        (algorithm, algorithm))
+    for hash_a, hash_b, shared in cursor:
+      yield BlobToDigest(hash_a), BlobToDigest(hash_b), shared
+
+  def FilesWithHash(self, md5hash, algorithm='md5'):
+    self.Flush()
+    return self.SelectFileStats(
+        'f.md5hash=? AND f.algorithm=?', (DigestToBlob(md5hash), algorithm))
+
+  def ExportRows(self):
+    """Yields (hash, size, algorithm, full path, timestamp_seconds) for every
+    file with a hash, ordered by hash, size, algorithm and path."""
+    self.Flush()
+    cursor = self.connection.cursor()
+    cursor.execute(
+        "SELECT f.md5hash, f.size, f.algorithm, d.path || '/' || f.base_name, "
+        "f.timestamp_seconds FROM %s WHERE f.md5hash IS NOT NULL "
+        "ORDER BY f.md5hash, f.size, f.algorithm, "
+        "d.path || '/' || f.base_name" % FILE_STATS_TABLES)
+    for md5hash, size, algorithm, path, timestamp_seconds in cursor:
+      yield BlobToDigest(md5hash), size, algorithm, path, timestamp_seconds
+
+  def GetByInode(self, device, inode):
+    """Returns the FileStats of the files that had the given device and inode
+    number when they were hashed, whatever their path."""
     result = []
-    for row in cursor.fetchall():
-      result.append(self.MakeFileStats(row))
+    file_stats = self.pending_inodes.get((device, inode))
+    if file_stats:
+      result.append(file_stats)
+    result.extend(
+        self.SelectFileStats('f.inode=? AND f.device=?', (inode, device)))
     return result
 
-  def MakeFileStats(self, row):
-    return FileStats(row[0], row[1], row[2], row[3], row[4])
-
-  def FilePathMatch(self, name_like):
+  def SelectFileStats(self, condition, parameters):
+    """Returns the FileStats of the rows that match an SQL condition over
+    FILE_STATS_TABLES. The FileStats of a directory share its path
+    string."""
     cursor = self.connection.cursor()
     cursor.execute(
-        'SELECT * FROM file_stats WHERE path || "/" || base_name LIKE ?',
-        (name_like,))
+        'SELECT %s FROM %s WHERE %s' % (
+            ', '.join(FILE_STATS_COLUMNS), FILE_STATS_TABLES, condition),
+        parameters)
+    paths = {}
     result = []
     for row in cursor.fetchall():
-      result.append(self.MakeFileStats(row))
+      path = paths.setdefault(row[0], row[0])
+      result.append(self.MakeFileStats((path,) + row[1:]))
     return result
 
+  def MakeFileStats(self, row):
+    """Returns the FileStats of a row of FILE_STATS_COLUMNS."""
+    return FileStats(row[0], row[1], BlobToDigest(row[2]), row[3], row[4],
+                     row[5], BlobToDigest(row[6]), row[7], row[8], row[9])
+
+  def CreateLookupTable(self):
+    """Creates an empty temporary table of files to look up, see
+    AddLookupFiles."""
+    cursor = self.connection.cursor()
+    cursor.execute(
+        'CREATE TEMP TABLE IF NOT EXISTS lookup_files (filename text, '
+        'md5hash blob, size integer, algorithm text)')
+    cursor.execute('DELETE FROM lookup_files')
+
+  def AddLookupFiles(self, rows):
+    """Adds (filename, md5hash, size, algorithm) rows to the lookup
+    table."""
+    cursor = self.connection.cursor()
+    cursor.execute('BEGIN')
+    cursor.executemany(
+        'INSERT INTO lookup_files (filename, md5hash, size, algorithm) '
+        'VALUES (?,?,?,?)',
+        [(filename, DigestToBlob(md5hash), size, algorithm)
+         for filename, md5hash, size, algorithm in rows])
+    cursor.execute('COMMIT')
+
+  def LookupAll(self):
+    """Yields (filename, FileStats) for each file of the database that has
+    the same hash and size as a file of the lookup table, with a single
+    query. Results come in the order in which files were added to the lookup
+    table."""
+    self.Flush()
+    cursor = self.connection.cursor()
+    cursor.execute(
+        'SELECT l.filename, %s FROM %s JOIN lookup_files l '
+        'ON f.md5hash=l.md5hash AND f.size=l.size AND f.algorithm=l.algorithm '
+        'ORDER BY l.rowid' % (
+            ', '.join(FILE_STATS_COLUMNS), FILE_STATS_TABLES))
+    for row in cursor:
+      yield row[0], self.MakeFileStats(row[1:])
+
+  def DuplicateGroups(self):
+    """Yields the groups of files of the whole database that have the same
+    hash and size, as lists of FileStats, the most reclaimable bytes first
+    (hard links count as one file, see DistinctFileCount). Empty files are
+    ignored. Groups are read one at a time."""
+    self.Flush()
+    cursor = self.connection.cursor()
+    cursor.execute(
+        'SELECT md5hash, size, algorithm FROM file_stats '
+        'WHERE md5hash IS NOT NULL AND size > 0 '
+        'GROUP BY md5hash, size, algorithm HAVING COUNT(*) > 1 '
+        "ORDER BY (COUNT(DISTINCT device || ':' || inode) "
+        '+ COUNT(*) - COUNT(inode) - 1) * size DESC')
+    for md5hash, size, algorithm in cursor:
+      yield self.Lookup(BlobToDigest(md5hash), size, algorithm)
+
+  def FilePathMatch(self, name_like):
+    self.Flush()
+    if self.has_path_index and CanUsePathIndex(name_like):
+      return self.SelectFileStats(
+          'f.rowid IN (SELECT rowid FROM file_paths WHERE full_path LIKE ?)',
+          (name_like,))
+    return self.SelectFileStats(
+        "d.path || '/' || f.base_name LIKE ?", (name_like,))
+
+  def FilePathGlob(self, name_glob):
+    self.Flush()
+    # The case-insensitive trigram index only serves LIKE, so it is queried
+    # with a LIKE pattern that matches at least the same paths.
+    name_like = GlobToLike(name_glob)
+    if self.has_path_index and CanUsePathIndex(name_like):
+      return self.SelectFileStats(
+          "f.rowid IN (SELECT rowid FROM file_paths WHERE full_path LIKE ?) "
+          "AND d.path || '/' || f.base_name GLOB ?", (name_like, name_glob))
+    return self.SelectFileStats(
+        "d.path || '/' || f.base_name GLOB ?", (name_glob,))
 
-def Call(args):
-  process = subprocess.Popen(
-      args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-  return [line for line in process.stdout], [line for line in process.stderr]
 
+def GlobToLike(glob):
+  """Returns a LIKE pattern that matches at least the paths that glob
+  matches with GLOB: * becomes %, and ? or a character class becomes _.
+  Classes are parsed as GLOB and fnmatch do: after the '[' and an optional
+  '^' (or '!'), a ']' is a member of the class rather than its end."""
+  like = []
+  i = 0
+  while i < len(glob):
+    c = glob[i]
+    if c == '*':
+      like.append('%')
+    elif c == '?':
+      like.append('_')
+    elif c == '[':
+      end = i + 1
+      if end < len(glob) and glob[end] in '^!':
+        end += 1
+      if end < len(glob) and glob[end] == ']':
+        end += 1
+      end = glob.find(']', end)
+      if end < 0:
+        like.append(c)  # Not a class.
+      else:
+        like.append('_')
+        i = end
+    else:
+      like.append(c)
+    i += 1
+  return ''.join(like)
 
-def HashFile(filename, console):
-  '''Returns md5 hash of the file, or None if there was an error.
+
+# The trigram index of file_paths only finds the paths of a LIKE pattern
+# with at least this many consecutive literal characters.
+PATH_INDEX_MIN_LITERAL = 3
+
+def CanUsePathIndex(name_like):
+  """Whether the file_paths index returns every path that name_like
+  matches: with shorter literal runs, sqlite's trigram LIKE can miss
+  matches, e.g. of '%/\xc9%' (non-ASCII). Runs are counted in
+  characters."""
+  if isinstance(name_like, str):
+    name_like = name_like.decode('utf8')
+  return max(len(run) for run in re.split('[%_]', name_like)) >= (
+      PATH_INDEX_MIN_LITERAL)
+
+
+def Fadvise(fd, offset, length, advice):
+  """Calls posix_fadvise where it is available. The advice is only a hint,
+  so failures are ignored."""
+  if posix_fadvise is None:
+    return
+  try:
+    posix_fadvise(fd, offset, length, advice)
+  except OSError:
+    pass
+
+
+def Prefetch(filename, length=PREFETCH_BYTES):
+  """Asks the kernel to start reading the first length bytes of filename."""
+  try:
+    fd = os.open(filename, os.O_RDONLY)
+  except OSError:
+    return
+  try:
+    Fadvise(fd, 0, length, POSIX_FADV_WILLNEED)
+  finally:
+    os.close(fd)
+
+
+def FirstExtentOffset(fd):
+  """Returns the physical offset on disk of the first extent of the open
+  file, or 0 if it has no extent. Raises IOError if the filesystem does not
+  support FIEMAP."""
+  buf = (FIEMAP_HEADER.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+         + '\0' * FIEMAP_EXTENT.size)
+  buf = fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+  mapped_extents = FIEMAP_HEADER.unpack_from(buf)[3]
+  if not mapped_extents:
+    return 0
+  return FIEMAP_EXTENT.unpack_from(buf, FIEMAP_HEADER.size)[1]
+
+
+def HashFile(filename, console, algorithm='md5', fadvise=False):
+  '''Returns the hex digest of the file, or None if there was an error.
   For example, the current user may not have permission to read the
-  file.
+  file. With fadvise, the kernel is told that the file is read sequentially
+  and that its pages can be dropped from the page cache afterwards.
   '''
-  success = False
-  global MD5SUM
-  for md5sum_command in MD5SUM:
+  hasher = HASH_ALGORITHMS[algorithm]()
+  try:
+    f = open(filename, 'rb')
     try:
-      output_lines, err_lines = Call(md5sum_command + [filename])
-      success = True
-      break
-    except OSError:
-      pass
-  if not success:
-    raise Exception('Did not find md5 command')
-  MD5SUM = [md5sum_command]
-  if len(output_lines) != 1:
-    err = err_lines[0].replace(filename, '').strip()
-    console.Error('Could not hash %s: %s' % (filename, err))
+      if fadvise:
+        Fadvise(f.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+      while True:
+        chunk = f.read(HASH_CHUNK_SIZE)
+        if not chunk:
+          break
+        hasher.update(chunk)
+      if fadvise:
+        Fadvise(f.fileno(), 0, 0, POSIX_FADV_DONTNEED)
+    finally:
+      f.close()
+  except (IOError, OSError), e:
+    console.Error('Could not hash %s: %s' % (filename, e.strerror))
     return None
-  tokens = output_lines[0].split(' ')
-  if len(tokens) < 1:
-    console.Print('No space in output lines when hashing %s:\n%s' % (
-        filename, output_lines[0]))
+  return hasher.hexdigest()
+
+
+def HashFilePartial(filename, console, size, algorithm='md5'):
+  '''Returns the hex digest of the first and last PARTIAL_HASH_BYTES of the
+  file, or None if there was an error. For files of at most
+  2 * PARTIAL_HASH_BYTES, this is the same as HashFile.
+  '''
+  hasher = HASH_ALGORITHMS[algorithm]()
+  try:
+    f = open(filename, 'rb')
+    try:
+      if size <= 2 * PARTIAL_HASH_BYTES:
+        hasher.update(f.read())
+      else:
+        hasher.update(f.read(PARTIAL_HASH_BYTES))
+        f.seek(-PARTIAL_HASH_BYTES, os.SEEK_END)
+        hasher.update(f.read(PARTIAL_HASH_BYTES))
+    finally:
+      f.close()
+  except (IOError, OSError), e:
+    console.Error('Could not hash %s: %s' % (filename, e.strerror))
     return None
-  return tokens[0]
+  return hasher.hexdigest()
+
+
+def FindChunkBoundary(data):
+  """Returns the length of the chunk at the start of data, which holds
+  CHUNK_MAX_BYTES bytes unless the file ends sooner. Only the bytes that end
+  in a CHUNK_ANCHOR are tested, so most of the scanning is done by
+  str.find."""
+  end = min(len(data), CHUNK_MAX_BYTES)
+  i = CHUNK_MIN_BYTES - 1
+  while True:
+    i = data.find(CHUNK_ANCHOR, i, end)
+    if i < 0:
+      return end
+    if not zlib.crc32(data[i - CHUNK_WINDOW + 1:i + 1]) & CHUNK_MASK:
+      return i + 1
+    i += 1
+
+
+def ChunkFile(f, algorithm='md5', file_hasher=None):
+  """Splits the open file into content-defined chunks and yields
+  (offset, length, hex digest) for each. Since boundaries only depend on
+  the bytes around them, an insertion or a deletion only changes the
+  chunks next to it. At most CHUNK_MAX_BYTES + HASH_CHUNK_SIZE bytes are
+  held in memory. All the bytes read are also passed to file_hasher, if
+  any."""
+  data = ''
+  offset = 0
+  end_of_file = False
+  while True:
+    while not end_of_file and len(data) < CHUNK_MAX_BYTES:
+      block = f.read(HASH_CHUNK_SIZE)
+      if not block:
+        end_of_file = True
+        break
+      if file_hasher:
+        file_hasher.update(block)
+      data += block
+    if not data:
+      return
+    length = FindChunkBoundary(data)
+    yield offset, length, HASH_ALGORITHMS[algorithm](data[:length]).hexdigest()
+    offset += length
+    data = data[length:]
+
+
+def SplitIdenticalFiles(filenames, console, keep_single=False,
+                        block_size=HASH_CHUNK_SIZE):
+  """Returns the groups of files that have exactly the same bytes, as lists
+  of filenames in the order of filenames. Unless keep_single is set, files
+  that are unlike all the others are left out, as are files that cannot be
+  read.
+
+  All the files are read together, one block at a time, and a group is
+  split as soon as its files read different blocks. A file that is alone in
+  its group is not read any further. So each file is read at most once,
+  and at most block_size times the number of files are held in memory.
+  """
+  order = dict((filename, i) for i, filename in enumerate(filenames))
+  result = []
+  for digest, files in IdenticalFileGroups(filenames, console, block_size):
+    if len(files) > 1 or keep_single:
+      result.append(sorted(files, key=order.get))
+  result.sort(key=lambda files: order[files[0]])
+  return result
+
+
+def IdenticalFileGroups(filenames, console, block_size=HASH_CHUNK_SIZE,
+                        complete=False):
+  """Returns (md5 digest, filenames) for each group of identical files, see
+  SplitIdenticalFiles. The digest is None for files that were not read to
+  the end, which only happens to single files unless complete is set.
+
+  Groups of more than VERIFY_MAX_OPEN_FILES files are split in slices, which
+  are read completely. The groups of the slices that have the same digest
+  are then merged by comparing one file of each, which is the only case
+  where a file is read twice."""
+  if len(filenames) > VERIFY_MAX_OPEN_FILES:
+    by_digest = {}
+    for i in xrange(0, len(filenames), VERIFY_MAX_OPEN_FILES):
+      for digest, files in IdenticalFileGroups(
+          filenames[i:i + VERIFY_MAX_OPEN_FILES], console, block_size, True):
+        by_digest.setdefault(digest, []).append(files)
+    result = []
+    for digest, candidates in by_digest.iteritems():
+      if len(candidates) == 1:
+        result.append((digest, candidates[0]))
+        continue
+      by_representative = dict((files[0], files) for files in candidates)
+      for digest, representatives in IdenticalFileGroups(
+          [files[0] for files in candidates], console, block_size, complete):
+        result.append((digest, sum(
+            (by_representative[filename] for filename in representatives),
+            [])))
+    return result
+  result = []
+  opened = []
+  try:
+    for filename in filenames:
+      try:
+        opened.append((filename, open(filename, 'rb')))
+      except IOError, e:
+        console.Error('Could not read %s: %s' % (filename, e.strerror))
+    # (hasher of the bytes read so far, [(filename, file)]).
+    pending = [(hashlib.md5(), opened)]
+    while pending:
+      hasher, group = pending.pop()
+      by_block = {}
+      for filename, f in group:
+        try:
+          block = f.read(block_size)
+        except IOError, e:
+          console.Error('Could not read %s: %s' % (filename, e.strerror))
+          f.close()
+          continue
+        by_block.setdefault(block, []).append((filename, f))
+      for block, files in by_block.iteritems():
+        if block and (len(files) > 1 or complete):
+          block_hasher = hasher.copy()
+          block_hasher.update(block)
+          pending.append((block_hasher, files))
+          continue
+        for filename, f in files:
+          f.close()
+        digest = None
+        if not block:
+          digest = hasher.digest()
+        result.append((digest, [filename for filename, f in files]))
+  finally:
+    for filename, f in opened:
+      f.close()
+  return result
+
+
+class HashWorkerPool(object):
+  """Hashes files on worker threads.
+
+  Files are submitted through a bounded queue, so that the submitting thread
+  (typically the tree walker) cannot run arbitrarily far ahead of the
+  workers. Results are handed back to the submitting thread, which is the
+  only one that talks to the database.
+  """
+
+  def __init__(self, jobs, console, algorithm='md5', queue_size=None,
+               fadvise=False):
+    self.console = console
+    self.algorithm = algorithm
+    self.fadvise = fadvise
+    self.tasks = Queue.Queue(queue_size or 4 * jobs)
+    self.results = Queue.Queue()
+    self.pending_count = 0
+    self.threads = []
+    for i in xrange(jobs):
+      thread = threading.Thread(target=self.Work)
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def Work(self):
+    while True:
+      task = self.tasks.get()
+      if task is None:
+        return
+      filename, context = task
+      md5hash = HashFile(filename, self.console, self.algorithm, self.fadvise)
+      self.results.put((filename, context, md5hash))
+
+  def Submit(self, filename, context=None):
+    """Queues filename for hashing; blocks while the queue is full. The
+    context is returned unchanged with the result."""
+    self.tasks.put((filename, context))
+    self.pending_count += 1
+
+  def Results(self, block=False):
+    """Yields (filename, context, hash) for files that have been hashed. The
+    hash is None if the file could not be hashed. If block is True, waits
+    until all submitted files are done."""
+    while self.pending_count:
+      try:
+        # A timeout keeps the main thread responsive to KeyboardInterrupt.
+        result = self.results.get(block, 1)
+      except Queue.Empty:
+        if block:
+          continue
+        return
+      self.pending_count -= 1
+      yield result
+
+  def Close(self):
+    """Yields the remaining results, then stops the workers."""
+    for result in self.Results(block=True):
+      yield result
+    for thread in self.threads:
+      self.tasks.put(None)
+    for thread in self.threads:
+      thread.join()
+
+
+class DiskOrderScheduler(object):
+  """Reorders the files to hash by their location on disk, so that a
+  spinning disk reads them with few seeks instead of in directory order.
+
+  Files are buffered in windows of window_size files. Each window is sorted
+  by device, then by the physical offset of the first extent of each file
+  (FIEMAP), then by inode number; on filesystems without FIEMAP, this is
+  inode order. While a file is being hashed, the start of the next one is
+  read ahead (posix_fadvise WILLNEED).
+  """
+
+  def __init__(self, window_size=1000):
+    self.window_size = window_size
+    # st_dev of the filesystems that do not support FIEMAP.
+    self.no_fiemap_devices = set()
+
+  def GetLocation(self, filename, stat):
+    """Returns the sort key of the file."""
+    offset = 0
+    if stat.st_dev not in self.no_fiemap_devices:
+      try:
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+          offset = FirstExtentOffset(fd)
+        finally:
+          os.close(fd)
+      except (IOError, OSError), e:
+        if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY):
+          self.no_fiemap_devices.add(stat.st_dev)
+    return (stat.st_dev, offset, stat.st_ino)
+
+  def Order(self, files):
+    """Yields the (filename, stat) pairs of files, reordered."""
+    window = []
+    for filename, stat in files:
+      window.append((self.GetLocation(filename, stat), filename, stat))
+      if len(window) >= self.window_size:
+        for result in self.OrderWindow(window):
+          yield result
+        window = []
+    for result in self.OrderWindow(window):
+      yield result
+
+  def OrderWindow(self, window):
+    window.sort()
+    for i in xrange(len(window)):
+      if i + 1 < len(window):
+        Prefetch(window[i + 1][1])
+      yield window[i][1:]
+
+
+class DeviceConcurrency(object):
+  """Decides how many threads hash files of each device: hdd_jobs for
+  rotational disks, ssd_jobs for the other block devices and default_jobs
+  when /sys does not tell (e.g. network filesystems)."""
+
+  def __init__(self, hdd_jobs=1, ssd_jobs=8, default_jobs=1):
+    self.hdd_jobs = hdd_jobs
+    self.ssd_jobs = ssd_jobs
+    self.default_jobs = default_jobs
+
+  def IsRotational(self, st_dev):
+    """Returns whether the device is a rotational disk, None if unknown."""
+    block = '/sys/dev/block/%d:%d' % (os.major(st_dev), os.minor(st_dev))
+    if not os.path.exists(block):
+      return None
+    block = os.path.realpath(block)
+    # A partition has no queue of its own; its parent disk does.
+    for directory in (block, os.path.dirname(block)):
+      try:
+        f = open(os.path.join(directory, 'queue', 'rotational'))
+        try:
+          return f.read().strip() == '1'
+        finally:
+          f.close()
+      except IOError:
+        continue
+    return None
+
+  def GetJobs(self, st_dev):
+    rotational = self.IsRotational(st_dev)
+    if rotational is None:
+      return self.default_jobs
+    if rotational:
+      return self.hdd_jobs
+    return self.ssd_jobs
+
+
+def FilesystemType(st_dev):
+  """Returns the type of the filesystem mounted from device st_dev, from
+  /proc/self/mountinfo, or None if not found."""
+  device = '%d:%d' % (os.major(st_dev), os.minor(st_dev))
+  try:
+    f = open('/proc/self/mountinfo')
+  except IOError:
+    return None
+  try:
+    for line in f:
+      fields, separator, filesystem = line.partition(' - ')
+      fields = fields.split()
+      if separator and len(fields) > 2 and fields[2] == device:
+        return filesystem.split()[0]
+  finally:
+    f.close()
+  return None
+
+
+def ReflinkSupport(st_dev):
+  """Returns whether the filesystem of device st_dev supports reflinks,
+  from its type alone, or None if the type does not tell."""
+  filesystem = FilesystemType(st_dev)
+  if filesystem in REFLINK_FILESYSTEMS:
+    return True
+  if filesystem in NO_REFLINK_FILESYSTEMS:
+    return False
+  return None
+
+
+class ListdirEntry(object):
+  """Stand-in for the entries of os.scandir, for when neither os.scandir nor
+  the scandir module is available. Each entry costs one os.lstat, on first
+  use. As with os.scandir, is_dir and is_symlink are False for an entry
+  that was deleted since the listing."""
+
+  def __init__(self, directory, name):
+    self.name = name
+    self.path = os.path.join(directory, name)
+    self.lstat = None
+
+  def is_dir(self, follow_symlinks=False):
+    try:
+      return S_ISDIR(self.stat().st_mode)
+    except OSError:
+      return False
+
+  def is_symlink(self):
+    try:
+      return S_ISLNK(self.stat().st_mode)
+    except OSError:
+      return False
+
+  def stat(self, follow_symlinks=False):
+    if self.lstat is None:
+      self.lstat = os.lstat(self.path)
+    return self.lstat
+
+
+def StatEntry(entry):
+  """Returns the os.lstat result of an entry of ScanDirectory. A function of
+  its own so that --profile can time it."""
+  return entry.stat(follow_symlinks=False)
+
+
+def ScanDirectory(directory):
+  """Returns the entries of directory, like os.scandir."""
+  if scandir:
+    return list(scandir(directory))
+  return [ListdirEntry(directory, name) for name in os.listdir(directory)]
+
+
+class FileEntry(object):
+  """A regular file found by the TreeWalker, with the os.lstat result that was
+  gathered while walking."""
+  __slots__ = ('filename', 'stat')
+
+  def __init__(self, filename, stat):
+    self.filename = filename
+    self.stat = stat
+
+  def GetFilename(self):
+    return self.filename
+
+  def GetStat(self):
+    return self.stat
+
+  def IsDirectory(self):
+    return False
+
+
+class DirectoryEntry(object):
+  """A directory whose files have all been yielded by the TreeWalker."""
+  __slots__ = ('path', 'stat', 'entry_count')
+
+  def __init__(self, path, stat, entry_count):
+    self.path = path
+    self.stat = stat
+    self.entry_count = entry_count
+
+  def GetPath(self):
+    return self.path
+
+  def GetStat(self):
+    return self.stat
+
+  def GetEntryCount(self):
+    return self.entry_count
+
+  def IsDirectory(self):
+    return True
+
+
+# Rules of ExclusionRules that apply unless they are overridden.
+DEFAULT_EXCLUSION_RULES = [
+  '.AppleDouble/',
+  '*.swp',
+  '.~lock.*',
+  '.DS_Store',
+]
+
+
+def GlobToRegex(glob):
+  """Translates a gitignore glob to a regex over paths: * and ? do not match
+  '/', ** matches any number of directories, [...] is a character class
+  ([!...] negated) and a backslash escapes the next character."""
+  regex = []
+  i = 0
+  while i < len(glob):
+    c = glob[i]
+    if glob.startswith('**/', i):
+      regex.append('(?:.*/)?')
+      i += 3
+      continue
+    if glob.startswith('**', i):
+      regex.append('.*')
+      i += 2
+      continue
+    if c == '*':
+      regex.append('[^/]*')
+    elif c == '?':
+      regex.append('[^/]')
+    elif c == '[' and ']' in glob[i + 2:]:
+      end = glob.index(']', i + 2)
+      content = glob[i + 1:end].replace('\\', '\\\\')
+      if content.startswith('!'):
+        content = '^' + content[1:]
+      regex.append('[%s]' % content)
+      i = end
+    elif c == '\\' and i + 1 < len(glob):
+      i += 1
+      regex.append(re.escape(glob[i]))
+    else:
+      regex.append(re.escape(c))
+    i += 1
+  return ''.join(regex)
+
+
+# Groups per compiled regex of ExclusionRules; re allows at most 100.
+EXCLUSION_RULES_PER_REGEX = 99
+
+class ExclusionRules(object):
+  """Gitignore-style rules over absolute paths, compiled into regexes of up
+  to EXCLUSION_RULES_PER_REGEX rules each.
+
+  Each rule is a glob (see GlobToRegex). As in .gitignore files:
+    - a rule without '/' matches a name at any depth, and one with a leading
+      '/' matches from the root of the file system (rules are not relative
+      to the location of a file). Other rules with a '/' match at any depth;
+    - a trailing '/' only matches directories;
+    - a leading '!' re-includes what an earlier rule excluded: the last
+      matching rule wins;
+    - blank lines and lines starting with '#' are ignored, as are trailing
+      spaces unless escaped with a backslash, and line ends (CRLF too).
+  A rule that matches a directory also matches everything below it, so that
+  the walk does not need to enter excluded directories. Directory paths are
+  checked with a trailing '/'.
+  """
+
+  def __init__(self, rules=()):
+    # (regex, negated) of the rules, in order.
+    self.rules = []
+    # (matcher, index after its last rule), last rules first.
+    self.matchers = []
+    self.AddRules(rules)
+
+  def AddRules(self, rules):
+    for rule in rules:
+      rule = rule.rstrip('\r\n')
+      stripped = rule.rstrip(' ')
+      if stripped != rule and stripped.endswith('\\'):
+        stripped += ' '  # An escaped space is kept.
+      rule = stripped
+      if not rule.strip() or rule.startswith('#'):
+        continue
+      negated = rule.startswith('!')
+      if negated:
+        rule = rule[1:]
+      elif rule.startswith('\\#') or rule.startswith('\\!'):
+        rule = rule[1:]
+      directory_only = rule.endswith('/')
+      rule = rule.rstrip('/')
+      if rule.startswith('/'):
+        regex = GlobToRegex(rule)
+      else:
+        regex = '(?:.*/)?' + GlobToRegex(rule)
+      if directory_only:
+        regex += '/.*'
+      else:
+        regex += '(?:/.*)?'
+      self.rules.append((regex, negated))
+    self.matchers = []
+    for start in xrange(0, len(self.rules), EXCLUSION_RULES_PER_REGEX):
+      chunk = self.rules[start:start + EXCLUSION_RULES_PER_REGEX]
+      # The last rules come first, so that the first alternative that
+      # matches is the last matching rule.
+      self.matchers.insert(0, (re.compile('^(?:%s)$' % '|'.join(
+          '(%s)' % regex for regex, negated in reversed(chunk)), re.DOTALL),
+          start + len(chunk)))
+
+  def AddFile(self, filename):
+    """Adds the rules of a file, one per line."""
+    f = open(filename)
+    try:
+      self.AddRules(line.decode('utf8') for line in f)
+    finally:
+      f.close()
+
+  def IsExcluded(self, path):
+    """Whether path is excluded; directories end with '/'."""
+    for matcher, end in self.matchers:
+      match = matcher.match(path)
+      if match:
+        return not self.rules[end - match.lastindex][1]
+    return False
+
+
+def WalkKey(directory):
+  """Returns a key that sorts directories in the order of a TreeWalker walk:
+  depth first, each directory before its subdirectories, and siblings
+  sorted by name."""
+  return directory.rstrip('/').split('/')
 
 
 class TreeWalker(object):
 
-  def __init__(self, console):
+  def __init__(self, console, exclusion_rules=None):
     self.console = console
-    self.exclusion_patterns = [
-        re.compile('/\.AppleDouble/'),
-        re.compile('\.swp$'),
-        re.compile('\.~lock\.'),
-        re.compile('/\.DS_Store$'),
-        ]
+    if exclusion_rules is None:
+      exclusion_rules = ExclusionRules(DEFAULT_EXCLUSION_RULES)
+    self.exclusion_rules = exclusion_rules
 
   def IsExcluded(self, filename):
-    for pattern in self.exclusion_patterns:
-      if pattern.search(filename):
-        return True
-    return False
+    """Whether a file, or a directory given with a trailing '/', is
+    excluded by the exclusion rules."""
+    return self.exclusion_rules.IsExcluded(filename)
+
+  def IsExcludedDirectory(self, directory):
+    """Whether the walk should not enter directory, a byte string."""
+    try:
+      decoded = directory.decode('utf8')
+    except UnicodeDecodeError:
+      return False  # Its files are reported by Utf8Decode.
+    return self.IsExcluded(decoded + '/')
 
   def Utf8Decode(self, s):
     try:
@@ -237,9 +2221,11 @@ class TreeWalker(object):
       return None
     return filename
 
-  def Walk(self, paths, name, callback):
-    """Processes all files / directories recursively, and calls the callback on
-    each absolute filename.
+  def Walk(self, paths, name, expected_count=None, directories=None,
+           resume=None):
+    """Explores all files / directories recursively in a single pass, and
+    yields a FileEntry for each regular file. Every file is stat'ed once, and
+    the result is kept in the FileEntry.
 
     Parameters
     ----------
@@ -249,96 +2235,1587 @@ class TreeWalker(object):
         be skipped (an error will be displayed).
     name: str
         Name of the operation, for the progress indicator.
-    callback: function
-        Function of one parameter (the absolute file name). Will be called on
-        each file.
+    expected_count: int
+        Estimated number of files, for the progress indicator. For example,
+        the number of files that a previous walk found.
+    directories: IncrementalScan
+        If given, the files of each directory for which
+        directories.IsDirectoryUnchanged(path, stat, entry_count) is true are
+        skipped; its subdirectories are still explored. For every other
+        directory, a DirectoryEntry is yielded after its files. Without
+        scandir, the entries of an unchanged directory that are among
+        directories.GetFileNames(path) are not stat'ed either.
+        directories.StartRoot(index) is called before walking paths[index].
+    resume: ScanCheckpoint
+        If given, the walk starts at its position: the paths before its root
+        index, and the directories before its cursor, are skipped without
+        being listed; the cursor and its ancestors are only listed for
+        their subdirectories.
+
+    The walk order only depends on the names of the files and directories,
+    so that a walk can be resumed.
     """
-    paths = [os.path.abspath(os.path.expanduser(p)) for p in paths]
-    # First pass: Gather statistics on files and directories.
-    files = []
-    directories = set()
-    for path_argument in paths:
-      if not os.path.exists(path_argument):
+    counts = {'files': 0, 'directories': 0, 'unchanged': 0}
+    root_index = 0
+    resume_key = None
+    if resume:
+      root_index = resume.GetRootIndex()
+      if resume.GetCursor() is not None:
+        resume_key = WalkKey(resume.GetCursor().encode('utf8'))
+    for index, path_argument in enumerate(AbsolutePaths(paths)):
+      if index < root_index:
+        continue
+      if directories:
+        directories.StartRoot(index)
+      try:
+        stat = os.stat(path_argument)
+      except OSError:
         self.console.Error('Path %s does not exist' % path_argument)
         continue
-      if not os.path.isdir(path_argument):
-        files.append(path_argument)  # TODO: Do the counting right here.
+      if S_ISDIR(stat.st_mode):
+        if index > root_index:
+          resume_key = None
+        for entry in self.WalkDirectory(path_argument, name, expected_count,
+                                        counts, directories, resume_key):
+          yield entry
         continue
-      for root, folders, regular_files in os.walk(path_argument, topdown=False):
-        for filename in regular_files:
-          filename = self.MakeAcceptableFile(os.path.join(root, filename))
-          if filename:
-            files.append(filename)
-            directories.add(root)
-            self.console.Flash('%s: %d files, %d directories: %s' % (
-                name, len(files), len(directories), root))
-
-    # Second pass: actual processing.
-    processed_directories = set()
-    file_count = 0
-    for path_argument in paths:
-      if not os.path.exists(path_argument):
-        # Error was already printed above.
+      filename = self.MakeAcceptableFile(path_argument)
+      if filename and S_ISREG(stat.st_mode):
+        counts['files'] += 1
+        yield FileEntry(filename, stat)
+
+  def WalkDirectory(self, root, name, expected_count, counts, directories,
+                    resume_key=None):
+    """Yields a FileEntry for each regular file below root, from the
+    directory whose WalkKey is resume_key on if given. Symbolic links are
+    not followed."""
+    stack = [root]
+    while stack:
+      directory = stack.pop()
+      resumed = False
+      if resume_key:
+        key = WalkKey(directory)
+        if key == resume_key[:len(key)]:
+          # The cursor or one of its ancestors; their files are done.
+          resumed = True
+        elif key < resume_key:
+          continue  # Its whole subtree is done.
+        else:
+          resume_key = None  # The rest of the walk comes after the cursor.
+      try:
+        if directories and not resumed:
+          # Taken before the listing, so that later changes are noticed.
+          directory_stat = os.lstat(directory)
+        entries = ScanDirectory(directory)
+      except OSError, e:
+        self.console.Error('Could not list %s: %s' % (directory, e.strerror))
+        continue
+      entries.sort(key=lambda entry: entry.name)
+      counts['directories'] += 1
+      unchanged = False
+      decoded_directory = None
+      if directories and not resumed:
+        decoded_directory = self.Utf8Decode(directory)
+        unchanged = decoded_directory and directories.IsDirectoryUnchanged(
+            decoded_directory, directory_stat, len(entries))
+      if unchanged:
+        counts['unchanged'] += 1
+        self.console.Flash('%s: file %d, directory %d, %d unchanged: %s' % (
+            name, counts['files'], counts['directories'], counts['unchanged'],
+            directory))
+      known_files = ()
+      if unchanged and not scandir:
+        # Entries that were files when the directory was recorded still are,
+        # since replacing them would have changed its mtime; only the others
+        # are stat'ed to find the subdirectories.
+        known_files = directories.GetFileNames(decoded_directory)
+      subdirectories = []
+      for entry in entries:
+        if entry.name in known_files:
+          continue
+        if entry.is_dir(follow_symlinks=False):
+          # Excluded subtrees are never listed.
+          if not self.IsExcludedDirectory(entry.path):
+            subdirectories.append(entry.path)
+          continue
+        if unchanged or resumed or entry.is_symlink():
+          continue
+        filename = self.Utf8Decode(entry.path)
+        if not filename or self.IsExcluded(filename):
+          continue
+        try:
+          stat = StatEntry(entry)
+        except OSError:
+          continue  # Deleted since the listing.
+        if not S_ISREG(stat.st_mode):
+          continue
+        counts['files'] += 1
+        if expected_count:
+          self.console.Flash('%s: file %d/~%d, directory %d: %s' % (
+              name, counts['files'], max(expected_count, counts['files']),
+              counts['directories'], directory))
+        else:
+          self.console.Flash('%s: file %d, directory %d: %s' % (
+              name, counts['files'], counts['directories'], directory))
+        yield FileEntry(filename, stat)
+      if decoded_directory and not unchanged:
+        yield DirectoryEntry(decoded_directory, directory_stat, len(entries))
+      subdirectories.sort(reverse=True)
+      stack.extend(subdirectories)
+
+
+def DistinctFileCount(identities):
+  """Returns the number of distinct files among (device, inode) pairs:
+  hard links count once. A pair with no inode (rows written before
+  they were recorded) counts as a file of its own."""
+  known = set()
+  unknown = 0
+  for device, inode in identities:
+    if inode is None:
+      unknown += 1
+    else:
+      known.add((device, inode))
+  return len(known) + unknown
+
+
+def OpenOutput(output):
+  """Returns stdout for '-', otherwise output opened for writing."""
+  if output == '-':
+    return sys.stdout
+  return open(output, 'wb')
+
+
+def AbsolutePaths(paths):
+  return [os.path.abspath(os.path.expanduser(p)) for p in paths]
+
+
+EXPORT_FORMAT = 'dupes2 export'
+EXPORT_VERSION = 1
+# Number of exports that MergeExports reads at the same time.
+MERGE_FAN_IN = 64
+
+def WriteExport(output, rows, header):
+  """Writes an export to output ('-' for stdout): gzip-compressed lines of
+  json, the header object (with format and version added) then one
+  [hash, size, algorithm, host, volume, path, timestamp_seconds] array per
+  row. Rows must come in that order, which is the order of their tuples, so
+  that exports can be merged. Returns the number of rows."""
+  if output == '-':
+    f = gzip.GzipFile(fileobj=sys.stdout, mode='wb')
+  else:
+    f = gzip.open(output, 'wb')
+  header = dict(header, format=EXPORT_FORMAT, version=EXPORT_VERSION)
+  f.write(json.dumps(header) + '\n')
+  count = 0
+  for row in rows:
+    f.write(json.dumps(row, ensure_ascii=False).encode('utf8') + '\n')
+    count += 1
+  f.close()
+  return count
+
+
+def ReadExport(filename):
+  """Yields the rows of an export (see WriteExport) as tuples."""
+  f = gzip.open(filename, 'rb')
+  try:
+    header = json.loads(f.readline() or '{}')
+    if header.get('format') != EXPORT_FORMAT:
+      raise Exception('%s is not a dupes2 export' % filename)
+    if header.get('version') > EXPORT_VERSION:
+      raise Exception('%s has a newer export version: %s' % (
+          filename, header.get('version')))
+    for line in f:
+      yield tuple(json.loads(line.decode('utf8')))
+  finally:
+    f.close()
+
+
+def MergeExports(filenames):
+  """Yields the rows of all the exports in order, with a k-way merge that
+  keeps one row per export in memory. With more than MERGE_FAN_IN exports,
+  groups of them are first merged into temporary exports, in as many passes
+  as needed, so that the number of open files stays bounded."""
+  temporary_files = []
+  try:
+    while len(filenames) > MERGE_FAN_IN:
+      merged = []
+      for start in xrange(0, len(filenames), MERGE_FAN_IN):
+        fd, temporary = tempfile.mkstemp(prefix='dupes2_merge_',
+                                         suffix='.gz')
+        os.close(fd)
+        temporary_files.append(temporary)
+        WriteExport(temporary, heapq.merge(*[
+            ReadExport(filename)
+            for filename in filenames[start:start + MERGE_FAN_IN]]), {})
+        merged.append(temporary)
+      filenames = merged
+    for row in heapq.merge(*[ReadExport(filename) for filename in filenames]):
+      yield row
+  finally:
+    for temporary in temporary_files:
+      os.remove(temporary)
+
+
+class Inotify(object):
+  """Minimal inotify binding (Linux only), through ctypes."""
+
+  IN_MODIFY = 0x00000002
+  IN_ATTRIB = 0x00000004
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_FROM = 0x00000040
+  IN_MOVED_TO = 0x00000080
+  IN_CREATE = 0x00000100
+  IN_DELETE = 0x00000200
+  IN_Q_OVERFLOW = 0x00004000
+  IN_IGNORED = 0x00008000
+  IN_ONLYDIR = 0x01000000
+  IN_DONT_FOLLOW = 0x02000000
+  IN_EXCL_UNLINK = 0x04000000
+  IN_ISDIR = 0x40000000
+
+  # struct inotify_event, without the name that follows it.
+  EVENT_HEADER = struct.Struct('iIII')
+
+  def __init__(self):
+    self.libc = ctypes.CDLL(
+        ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    if not hasattr(self.libc, 'inotify_init1'):
+      raise Exception('inotify is not available on this system')
+    self.libc.inotify_add_watch.argtypes = [
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    self.libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    self.fd = self.libc.inotify_init1(0)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+  def AddWatch(self, path, mask):
+    """Returns the watch descriptor."""
+    wd = self.libc.inotify_add_watch(self.fd, path, mask)
+    if wd < 0:
+      error = ctypes.get_errno()
+      raise OSError(error, os.strerror(error), path)
+    return wd
+
+  def RemoveWatch(self, wd):
+    self.libc.inotify_rm_watch(self.fd, wd)
+
+  def Read(self, timeout):
+    """Returns a list of (wd, mask, cookie, name) tuples, waiting at most
+    timeout seconds for the first event."""
+    try:
+      readable, writable, exceptional = select.select(
+          [self.fd], [], [], timeout)
+    except select.error, e:
+      if e.args[0] == errno.EINTR:
+        return []
+      raise
+    if not readable:
+      return []
+    buf = os.read(self.fd, 1 << 16)
+    events = []
+    offset = 0
+    while offset < len(buf):
+      wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(buf, offset)
+      offset += self.EVENT_HEADER.size
+      name = buf[offset:offset + length].rstrip('\0')
+      offset += length
+      events.append((wd, mask, cookie, name))
+    return events
+
+  def Close(self):
+    os.close(self.fd)
+
+
+class WatchDaemon(object):
+  """Keeps the database up to date with the files below a set of roots.
+
+  Every directory is watched with inotify. Events on a file are debounced:
+  the file is rehashed (or deleted from the database) once no event arrived
+  for it during debounce_seconds, however many events there were. Database
+  writes go through the repository batches, which are flushed whenever the
+  daemon becomes idle. New directories are rescanned. A directory renamed
+  within the roots (IN_MOVED_FROM and IN_MOVED_TO with the same cookie)
+  keeps its rows, moved to the new path (see MoveTree), so its rescan finds
+  its files cached; one moved away is deleted from the database once no
+  IN_MOVED_TO came for debounce_seconds. When the kernel event queue
+  overflows, the directories with unprocessed events are rescanned,
+  and an incremental scan of the roots catches the rest.
+  """
+
+  WATCH_MASK = (Inotify.IN_MODIFY | Inotify.IN_ATTRIB | Inotify.IN_CLOSE_WRITE
+      | Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO | Inotify.IN_CREATE
+      | Inotify.IN_DELETE | Inotify.IN_ONLYDIR | Inotify.IN_DONT_FOLLOW
+      | Inotify.IN_EXCL_UNLINK)
+
+  def __init__(self, dupes, roots, debounce_seconds=2):
+    self.dupes = dupes
+    self.repository = dupes.repository
+    self.tree_walker = dupes.tree_walker
+    self.console = dupes.console
+    self.roots = AbsolutePaths(roots)
+    self.debounce_seconds = debounce_seconds
+    self.inotify = Inotify()
+    # wd -> watched directory.
+    self.watches = {}
+    # filename -> time of its last event.
+    self.pending_files = {}
+    # directory -> time of its last event, for directories to rescan.
+    self.pending_directories = {}
+    # cookie -> (directory, time) of IN_MOVED_FROM without IN_MOVED_TO yet.
+    self.moved_directories = {}
+    self.overflow = False
+
+  def Run(self):
+    """Watches until interrupted."""
+    for root in self.roots:
+      self.WatchTree(root)
+    # Events that happen during this initial scan are queued by inotify.
+    self.dupes.HashPathsToDatabase(self.roots)
+    self.repository.Flush()
+    self.console.Print('Watching %d directories' % len(self.watches))
+    try:
+      while True:
+        for wd, mask, cookie, name in self.inotify.Read(self.GetTimeout()):
+          self.HandleEvent(wd, mask, cookie, name)
+        self.ProcessDueEvents()
+    except KeyboardInterrupt:
+      self.console.Print('Stopped watching')
+    finally:
+      self.inotify.Close()
+
+  def GetTimeout(self):
+    """Returns how long to wait for events before something is due."""
+    if self.overflow:
+      return 0
+    times = self.pending_files.values() + self.pending_directories.values()
+    times.extend(event_time
+                 for path, event_time in self.moved_directories.values())
+    if not times:
+      # Idle: save the batch.
+      self.repository.Flush()
+      return 1
+    return max(0, min(1, min(times) + self.debounce_seconds - time.time()))
+
+  def WatchTree(self, root):
+    stack = [root]
+    while stack:
+      directory = stack.pop()
+      decoded = self.tree_walker.Utf8Decode(directory)
+      if not decoded or self.tree_walker.IsExcluded(decoded + '/'):
+        continue
+      try:
+        wd = self.inotify.AddWatch(directory, self.WATCH_MASK)
+        entries = ScanDirectory(directory)
+      except OSError, e:
+        self.console.Error('Could not watch %s: %s' % (directory, e.strerror))
+        continue
+      self.watches[wd] = directory
+      for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+          stack.append(entry.path)
+
+  def UnwatchTree(self, root):
+    prefix = root + '/'
+    for wd, directory in self.watches.items():
+      if directory == root or directory.startswith(prefix):
+        self.inotify.RemoveWatch(wd)
+        del self.watches[wd]
+
+  def MoveWatches(self, root, new_root):
+    """Renames the watched directories at or below root, whose watches
+    follow them, to below new_root."""
+    prefix = root + '/'
+    for wd, directory in self.watches.items():
+      if directory == root or directory.startswith(prefix):
+        self.watches[wd] = new_root + directory[len(root):]
+
+  def HandleEvent(self, wd, mask, cookie, name):
+    now = time.time()
+    if mask & Inotify.IN_Q_OVERFLOW:
+      self.console.Error('Too many events, rescanning')
+      self.overflow = True
+      return
+    if mask & Inotify.IN_IGNORED:
+      self.watches.pop(wd, None)
+      return
+    if wd not in self.watches or not name:
+      return
+    path = os.path.join(self.watches[wd], name)
+    if not mask & Inotify.IN_ISDIR:
+      self.pending_files[path] = now
+      return
+    if mask & Inotify.IN_MOVED_TO and cookie in self.moved_directories:
+      self.MoveDirectory(self.moved_directories.pop(cookie)[0], path)
+      self.pending_directories[path] = now
+    elif mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+      self.WatchTree(path)
+      self.pending_directories[path] = now
+    elif mask & Inotify.IN_MOVED_FROM:
+      # Deleted by ProcessDueEvents unless its IN_MOVED_TO comes.
+      self.moved_directories[cookie] = (path, now)
+      self.pending_directories.pop(path, None)
+    elif mask & Inotify.IN_DELETE:
+      self.DeleteDirectory(path)
+
+  def MoveDirectory(self, path, new_path):
+    """Follows the rename of a watched directory."""
+    decoded = self.tree_walker.Utf8Decode(path)
+    new_decoded = self.tree_walker.Utf8Decode(new_path)
+    if (not decoded or not new_decoded
+        or self.tree_walker.IsExcluded(new_decoded + '/')):
+      self.DeleteDirectory(path)
+      self.WatchTree(new_path)
+      return
+    self.MoveWatches(path, new_path)
+    self.repository.MoveTree(decoded, new_decoded)
+
+  def DeleteDirectory(self, path):
+    self.UnwatchTree(path)
+    self.pending_directories.pop(path, None)
+    decoded = self.tree_walker.Utf8Decode(path)
+    if decoded:
+      self.repository.DeleteTree(decoded)
+
+  def DeleteMovedDirectories(self, due_time):
+    """Deletes the directories moved away before due_time."""
+    for cookie, (path, event_time) in self.moved_directories.items():
+      if event_time <= due_time:
+        del self.moved_directories[cookie]
+        self.DeleteDirectory(path)
+
+  def ProcessDueEvents(self):
+    if self.overflow:
+      self.overflow = False
+      # Their IN_MOVED_TO may be lost; a moved directory is found again by
+      # the scan of the roots.
+      self.DeleteMovedDirectories(time.time())
+      for filename in self.pending_files:
+        self.pending_directories[os.path.dirname(filename)] = 0
+      self.pending_files = {}
+      self.RescanDirectories(self.pending_directories.keys())
+      self.pending_directories = {}
+      self.dupes.HashPathsToDatabase(self.roots)
+      return
+    due_time = time.time() - self.debounce_seconds
+    self.DeleteMovedDirectories(due_time)
+    for filename, event_time in self.pending_files.items():
+      if event_time <= due_time:
+        del self.pending_files[filename]
+        self.UpdateFile(filename)
+    directories = [directory
+                   for directory, event_time in self.pending_directories.items()
+                   if event_time <= due_time]
+    for directory in directories:
+      del self.pending_directories[directory]
+    self.RescanDirectories(directories)
+
+  def RescanDirectories(self, directories):
+    directories = [d for d in directories if os.path.isdir(d)]
+    if directories:
+      self.dupes.HashPathsToDatabase(directories, full=True)
+
+  def UpdateFile(self, filename):
+    decoded = self.tree_walker.Utf8Decode(filename)
+    if not decoded or self.tree_walker.IsExcluded(decoded):
+      return
+    try:
+      stat = os.lstat(filename)
+    except OSError:
+      stat = None
+    if stat and S_ISREG(stat.st_mode):
+      self.dupes.HashFileToDatabase(decoded, stat)
+    elif not stat or not S_ISDIR(stat.st_mode):
+      path, base_name = os.path.split(decoded)
+      self.repository.Delete(path, base_name)
+
+
+class Deduper(object):
+  """Reclaims the space used by the duplicates of the database.
+
+  The files of each group of duplicates are compared byte by byte, per
+  device (see SplitIdenticalFiles). In each set of identical files, the
+  oldest one (by mtime, then by path) is kept and the others are replaced
+  by a reflink to it (FICLONE), which keeps them independent files, or by
+  a hard link to it if allow_hardlink is set and the filesystem has no
+  reflinks. The replacement is written next to the copy and renamed over
+  it, so the copy is never missing or partial. Files that changed since
+  they were hashed are left alone.
+
+  With dry_run, files are compared all the same but only the plan is
+  printed, without writing anything: where the filesystem type does not
+  tell whether reflinks are supported (see ReflinkSupport), which would
+  take a write to find out, the plan says so, and without allow_hardlink
+  the bytes of those files are not counted as reclaimed.
+  """
+
+  def __init__(self, dupes, allow_hardlink=False, dry_run=False):
+    self.dupes = dupes
+    self.repository = dupes.repository
+    self.console = dupes.console
+    self.allow_hardlink = allow_hardlink
+    self.dry_run = dry_run
+    # st_dev -> whether its filesystem supports reflinks.
+    self.reflink_devices = {}
+    self.counts = collections.defaultdict(int)
+
+  def Run(self):
+    start = time.time()
+    for group in self.repository.DuplicateGroups():
+      self.DedupeGroup(group)
+    verb = 'Reclaimed'
+    if self.dry_run:
+      verb = 'Would reclaim'
+    summary = (
+        '%s %d bytes in %.1fs: %d groups, %d reflinks, %d hard links, '
+        '%d files skipped' % (
+            verb, self.counts['bytes'], time.time() - start,
+            self.counts['groups'], self.counts['reflinks'],
+            self.counts['hardlinks'], self.counts['skipped']))
+    if self.counts['unknown']:
+      summary += ', %d with unknown reflink support' % self.counts['unknown']
+      if self.counts['unknown_bytes']:
+        summary += ' (%d bytes not counted)' % self.counts['unknown_bytes']
+    self.console.Print(summary)
+
+  def DedupeGroup(self, group):
+    """Dedupes the files of a group, for each device."""
+    self.counts['groups'] += 1
+    by_device = collections.OrderedDict()
+    for file_stats in group:
+      filename = os.path.join(file_stats.GetPath(), file_stats.GetBaseName())
+      try:
+        stat = os.lstat(filename)
+      except OSError, e:
+        self.console.Error('Could not stat %s: %s' % (filename, e.strerror))
         continue
-      if not os.path.isdir(path_argument):
-        filename = self.MakeAcceptableFile(path_argument)
-        if filename:
-          callback(filename)  # TODO: Do the counting right here.
+      if (not S_ISREG(stat.st_mode)
+          or stat.st_size != file_stats.GetSize()
+          or int(stat.st_mtime) != file_stats.GetTimestampSeconds()):
+        self.console.Error('%s changed since it was hashed' % filename)
+        self.counts['skipped'] += 1
         continue
-      for root, folders, regular_files in os.walk(path_argument, topdown=False):
-        for filename in regular_files:
-          filename = self.MakeAcceptableFile(os.path.join(root, filename))
-          if filename:
-            file_count += 1
-            self.console.Flash('%s: file %d/%d, directory %d/%d: %s' % (
-                name, file_count, len(files), len(processed_directories),
-                len(directories), root))
-            callback(filename)
-            processed_directories.add(root)
+      by_device.setdefault(stat.st_dev, []).append(
+          (filename, stat, file_stats))
+    for files in by_device.itervalues():
+      by_filename = dict((file_info[0], file_info) for file_info in files)
+      identical_groups = SplitIdenticalFiles(
+          [file_info[0] for file_info in files], self.console, True)
+      for identical in identical_groups:
+        if len(identical) > 1:
+          self.DedupeIdenticalFiles(
+              [by_filename[filename] for filename in identical])
+        elif len(identical_groups) > 1:
+          self.console.Error(
+              '%s has the same hash as other files but differs' % identical[0])
+          self.counts['skipped'] += 1
+
+  def DedupeIdenticalFiles(self, files):
+    """Replaces the (filename, stat, file_stats) files by links to the
+    oldest one, by mtime then by path."""
+    files = sorted(files, key=lambda (filename, stat, file_stats): (
+        stat.st_mtime, filename))
+    keep_filename, keep_stat, keep_file_stats = files[0]
+    # The bytes of an inode are reclaimed once all its links are replaced.
+    inodes = set([keep_stat.st_ino])
+    for filename, stat, file_stats in files[1:]:
+      if stat.st_ino == keep_stat.st_ino:
+        continue  # Already a hard link to the kept file.
+      size = stat.st_size
+      if stat.st_ino in inodes:
+        size = 0
+      inodes.add(stat.st_ino)
+      self.Replace(keep_filename, filename, stat, file_stats, size)
+
+  def Replace(self, keep_filename, filename, stat, file_stats, size):
+    """Replaces filename, a copy of keep_filename, by a link to it. size is
+    the number of bytes that this reclaims."""
+    try:
+      use_reflink = self.HasReflinks(keep_filename, filename, stat)
+      if use_reflink is None:
+        # Only with dry_run.
+        self.counts['unknown'] += 1
+        if self.allow_hardlink:
+          action = 'reflink or hardlink'
+          self.counts['bytes'] += size
+        else:
+          action = 'reflink if supported'
+          self.counts['unknown_bytes'] += size
+        self.console.Print('%s %s -> %s' % (action, filename, keep_filename))
+        return
+      if not use_reflink and not self.allow_hardlink:
+        self.counts['skipped'] += 1
+        return
+      if self.dry_run:
+        self.console.Print('%s %s -> %s' % (
+            use_reflink and 'reflink' or 'hardlink', filename, keep_filename))
+      elif use_reflink:
+        self.Reflink(keep_filename, filename, stat)
+      else:
+        self.Hardlink(keep_filename, filename)
+    except (IOError, OSError), e:
+      self.console.Error('Could not dedupe %s: %s' % (filename, e.strerror))
+      self.counts['skipped'] += 1
+      return
+    self.counts['bytes'] += size
+    self.counts[use_reflink and 'reflinks' or 'hardlinks'] += 1
+    if self.dry_run:
+      return
+    self.console.Flash('dedupe: %d bytes reclaimed: %s' % (
+        self.counts['bytes'], filename))
+    self.dupes.SaveHash(filename, os.stat(filename), file_stats.GetHash(),
+                        file_stats.GetPartialHash())
+
+  def MakeTemporaryFile(self, filename):
+    """Returns (fd, path) of a new file in the directory of filename."""
+    directory, base_name = os.path.split(filename)
+    return tempfile.mkstemp(
+        prefix='.%s.' % base_name, suffix='.dupes2', dir=directory)
+
+  def Clone(self, keep_filename, fd):
+    """Makes the open file fd share the extents of keep_filename."""
+    source = os.open(keep_filename, os.O_RDONLY)
+    try:
+      fcntl.ioctl(fd, FICLONE, source)
+    finally:
+      os.close(source)
+
+  def HasReflinks(self, keep_filename, filename, stat):
+    """Returns whether the filesystem of filename supports reflinks. The
+    first time, this is found out from the filesystem type (see
+    ReflinkSupport) or, if that does not tell, by cloning keep_filename to
+    a temporary file, which only costs metadata; with dry_run, None is
+    returned instead."""
+    if stat.st_dev not in self.reflink_devices:
+      supported = ReflinkSupport(stat.st_dev)
+      if supported is None and not self.dry_run:
+        supported = self.ProbeReflinks(keep_filename, filename)
+      self.reflink_devices[stat.st_dev] = supported
+    return self.reflink_devices[stat.st_dev]
+
+  def ProbeReflinks(self, keep_filename, filename):
+    """Returns whether keep_filename can be cloned next to filename."""
+    fd, temporary = self.MakeTemporaryFile(filename)
+    try:
+      self.Clone(keep_filename, fd)
+      return True
+    except IOError, e:
+      if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                         errno.EXDEV):
+        raise
+      return False
+    finally:
+      os.close(fd)
+      os.remove(temporary)
+
+  def Reflink(self, keep_filename, filename, stat):
+    """Replaces filename by a reflink to keep_filename, with the metadata of
+    filename."""
+    fd, temporary = self.MakeTemporaryFile(filename)
+    try:
+      try:
+        self.Clone(keep_filename, fd)
+      finally:
+        os.close(fd)
+      try:
+        os.chown(temporary, stat.st_uid, stat.st_gid)
+      except OSError:
+        pass  # Only root may give files away.
+      shutil.copystat(filename, temporary)
+      os.rename(temporary, filename)
+    except:
+      os.remove(temporary)
+      raise
+
+  def Hardlink(self, keep_filename, filename):
+    fd, temporary = self.MakeTemporaryFile(filename)
+    os.close(fd)
+    os.remove(temporary)
+    os.link(keep_filename, temporary)
+    try:
+      os.rename(temporary, filename)
+    except:
+      os.remove(temporary)
+      raise
+
+
+class IncrementalScan(object):
+  """Directory bookkeeping for --hash_to_database.
+
+  The directories table holds the mtime and entry count that each directory
+  had when all of its files were last hashed. The tree walker skips the files
+  of directories where both are unchanged, unless full is set. A directory is
+  recorded once every file submitted from it has been saved, and not at all
+  if one of them could not be hashed.
+
+  A file that is rewritten in place does not change the mtime of its
+  directory, so only a full scan notices it.
+
+  With a checkpoint (a ScanCheckpoint), the scan also keeps its position in
+  the walk: once a directory and every directory walked before it are done,
+  whether or not all of their files could be hashed, the checkpoint moves to
+  it and is saved with the next batch of rows (see TreeWalker.Walk for
+  resuming from it).
+  """
+
+  def __init__(self, repository, algorithm='md5', full=False,
+               checkpoint=None):
+    self.repository = repository
+    self.algorithm = algorithm
+    self.full = full
+    self.checkpoint = checkpoint
+    # Index of the root being walked.
+    self.root_index = 0
+    # (root_index, directory) walked and not yet done, in walk order.
+    self.walk_order = collections.deque()
+    # Directories done while an earlier one of walk_order was not.
+    self.done = set()
+    self.files_done = 0
+    # directory -> number of files submitted but not yet saved.
+    self.outstanding = {}
+    # Directories with a file that could not be hashed.
+    self.failed = set()
+    # directory -> DirectoryEntry walked while files were outstanding.
+    self.walked = {}
+
+  def IsDirectoryUnchanged(self, directory, stat, entry_count):
+    if self.full:
+      return False
+    directory_stats = self.repository.GetDirectory(directory)
+    return bool(directory_stats
+        and directory_stats.GetMtimeNs() == MtimeNs(stat)
+        and directory_stats.GetEntryCount() == entry_count
+        and directory_stats.GetAlgorithm() == self.algorithm)
+
+  def GetFileNames(self, directory):
+    """Returns the base names, as utf8 byte strings, of the files of
+    directory in the database."""
+    return set(base_name.encode('utf8') for base_name in
+               self.repository.GetDirectoryFiles(directory))
+
+  def FileSubmitted(self, filename):
+    directory = os.path.dirname(filename)
+    self.outstanding[directory] = self.outstanding.get(directory, 0) + 1
+
+  def StartRoot(self, root_index):
+    self.root_index = root_index
+
+  def FileDone(self, filename, success):
+    self.files_done += 1
+    directory = os.path.dirname(filename)
+    if not success:
+      self.failed.add(directory)
+    self.outstanding[directory] -= 1
+    if not self.outstanding[directory]:
+      del self.outstanding[directory]
+      if directory in self.walked:
+        self.Record(self.walked.pop(directory))
+
+  def DirectoryWalked(self, directory_entry):
+    if self.checkpoint:
+      self.walk_order.append((self.root_index, directory_entry.GetPath()))
+    if directory_entry.GetPath() in self.outstanding:
+      self.walked[directory_entry.GetPath()] = directory_entry
+    else:
+      self.Record(directory_entry)
+
+  def Record(self, directory_entry):
+    path = directory_entry.GetPath()
+    if path in self.failed:
+      self.failed.remove(path)
+    else:
+      self.repository.UpsertDirectory(DirectoryStats(
+          path, MtimeNs(directory_entry.GetStat()),
+          directory_entry.GetEntryCount(), self.algorithm))
+    if self.checkpoint:
+      self.AdvanceCheckpoint(path)
+
+  def AdvanceCheckpoint(self, path):
+    """Marks the directory path as done, and moves the checkpoint past the
+    directories done at the start of walk_order."""
+    self.done.add(path)
+    position = None
+    directories = 0
+    while self.walk_order and self.walk_order[0][1] in self.done:
+      position = self.walk_order.popleft()
+      self.done.discard(position[1])
+      directories += 1
+    if not position:
+      return
+    checkpoint = self.checkpoint
+    self.checkpoint = ScanCheckpoint(
+        checkpoint.GetRoots(), checkpoint.GetAlgorithm(),
+        checkpoint.IsFull(), position[0], position[1],
+        checkpoint.GetFiles() + self.files_done,
+        checkpoint.GetDirectories() + directories)
+    self.files_done = 0
+    self.repository.SetCheckpoint(self.checkpoint)
+
+  def Finish(self):
+    """Deletes the checkpoint of a scan that walked all of its roots."""
+    if self.checkpoint:
+      self.repository.DeleteCheckpoint(self.checkpoint.GetRoots())
+
+
+class DeviceLane(object):
+  """Walks and hashes the paths of one device on its own threads.
+
+  The lane has its own read-only connection to the database to skip cached
+  files, and its own HashWorkerPool. Everything that must be written is
+  sent to the events queue as (kind, ...) tuples, for the thread that owns
+  the database:
+    ('directory', directory_entry)   see IncrementalScan.DirectoryWalked
+    ('submitted', filename)          see IncrementalScan.FileSubmitted
+    ('done', filename, success)      see IncrementalScan.FileDone
+    ('hashed', filename, stat, hash) a freshly computed hash to save
+    ('upsert', file_stats)           a row to save as is
+    ('finished', lane, exc_info)     exc_info is None unless the lane failed
+  """
+
+  def __init__(self, dupes, paths, jobs, events, full=False,
+               disk_order_window=0):
+    self.dupes = dupes
+    self.paths = paths
+    self.jobs = jobs
+    self.events = events
+    self.full = full
+    self.disk_order_window = disk_order_window
+    self.thread = threading.Thread(target=self.Run)
+    self.thread.daemon = True
+
+  def Start(self):
+    self.thread.start()
+
+  def Run(self):
+    try:
+      repository = FileStatsRepository(
+          self.dupes.repository.database_filename)
+      try:
+        self.HashPaths(repository)
+      finally:
+        repository.Close()
+    except:
+      self.events.put(('finished', self, sys.exc_info()))
+      return
+    self.events.put(('finished', self, None))
+
+  def HashPaths(self, repository):
+    dupes = LaneDupes(repository, self.dupes.tree_walker, self.dupes.console,
+                      self.dupes.algorithm, self.events)
+    self.scan = IncrementalScan(repository, dupes.algorithm, self.full)
+    files = dupes.FilesToHash(
+        dupes.WalkPaths(self.paths, 'hash_to_database', self), self)
+    fadvise = self.disk_order_window > 0
+    if fadvise:
+      files = DiskOrderScheduler(self.disk_order_window).Order(files)
+    pool = HashWorkerPool(
+        self.jobs, dupes.console, dupes.algorithm, fadvise=fadvise)
+    for filename, stat in files:
+      pool.Submit(filename, stat)
+      for filename, stat, md5hash in pool.Results():
+        self.events.put(('hashed', filename, stat, md5hash))
+    for filename, stat, md5hash in pool.Close():
+      self.events.put(('hashed', filename, stat, md5hash))
+
+  # The IncrementalScan interface expected by TreeWalker and FilesToHash.
+
+  def StartRoot(self, root_index):
+    pass
+
+  def IsDirectoryUnchanged(self, directory, stat, entry_count):
+    return self.scan.IsDirectoryUnchanged(directory, stat, entry_count)
+
+  def GetFileNames(self, directory):
+    return self.scan.GetFileNames(directory)
+
+  def DirectoryWalked(self, directory_entry):
+    self.events.put(('directory', directory_entry))
+
+  def FileSubmitted(self, filename):
+    self.events.put(('submitted', filename))
+
+  def FileDone(self, filename, success):
+    self.events.put(('done', filename, success))
 
 
 class Dupes(object):
 
-  def  __init__(self, repository, tree_walker, console):
+  def  __init__(self, repository, tree_walker, console, algorithm='md5',
+                metrics_output=None, metrics_seconds=10):
     self.repository = repository
     self.tree_walker = tree_walker
     self.console = console
+    self.algorithm = algorithm
+    # Where the ScanMetrics of --hash_to_database are written, if anywhere.
+    self.metrics_output = metrics_output
+    self.metrics_seconds = metrics_seconds
+    # The ScanMetrics of the running scan, if any.
+    self.metrics = None
+
+  def HashFileToDatabase(self, filename, stat=None):
+    """Retrieves timestamp and size from system, unless an os.stat result is
+    given. If those match the database values, the hash from the database is
+    returned. Otherwise, the hash is calculated. Returns the file stats
+    object. Returns None if the hash could not be computed."""
+    if stat is None:
+      stat = os.stat(filename)
+    from_database = self.GetCachedFileStats(filename, stat)
+    if from_database:
+      return from_database
+    md5hash, partial_hash = self.HashUncachedFile(filename, stat)
+    return self.SaveHash(filename, stat, md5hash, partial_hash)
+
+  def HashUncachedFile(self, filename, stat):
+    """Returns (hash, partial hash) for a file whose hash is not in the
+    database: those of the same file under another path if there is one
+    (see GetSameFileStats), otherwise the hash is computed. The hash is None
+    if it could not be computed."""
+    same_file = self.GetSameFileStats(stat)
+    if same_file:
+      return same_file.GetHash(), same_file.GetPartialHash()
+    return HashFile(filename, self.console, self.algorithm), None
+
+  def GetCachedFileStats(self, filename, stat):
+    """Returns the file stats from the database if they hold a hash that is
+    still valid for the given os.stat result, None otherwise."""
+    from_database = self.GetValidFileStats(filename, stat)
+    if from_database and from_database.GetHash():
+      return from_database
+    return None
 
-  def HashFileToDatabase(self, filename):
-    """Retrieves timestamp and size from system. If those match the database
-    values, the hash from the database is returned. Otherwise, the hash is
-    calculated. Returns the file stats object. Returns None if the hash
-    could not be computed."""
-    stat = os.stat(filename)
-    timestamp_seconds = int(stat.st_mtime)
-    size = stat.st_size
+  def GetValidFileStats(self, filename, stat):
+    """Like GetCachedFileStats, but also returns rows that only hold a
+    partial hash."""
     path, base_name = os.path.split(filename)
     from_database = self.repository.Get(path, base_name)
     if from_database:
-      if (from_database.GetTimestampSeconds() == timestamp_seconds
-          and from_database.GetSize() == size):
+      if (from_database.GetTimestampSeconds() == int(stat.st_mtime)
+          and from_database.GetSize() == stat.st_size
+          and from_database.GetAlgorithm() == self.algorithm):
         return from_database
-    md5hash = HashFile(filename, self.console)
+    return None
+
+  def GetSameFileStats(self, stat):
+    """Returns the file stats of a file that had the same device, inode,
+    size and mtime as the given os.stat result, under any path: a hard link
+    to the file, or the file before it was renamed. Returns None if there is
+    none with a hash."""
+    for file_stats in self.repository.GetByInode(stat.st_dev, stat.st_ino):
+      if (file_stats.GetHash()
+          and file_stats.GetSize() == stat.st_size
+          and file_stats.GetMtimeNs() == MtimeNs(stat)
+          and file_stats.GetAlgorithm() == self.algorithm):
+        return file_stats
+    return None
+
+  def NewFileStats(self, filename, stat, md5hash, partial_hash):
+    path, base_name = os.path.split(filename)
+    return FileStats(
+        path, base_name, md5hash, stat.st_size, int(stat.st_mtime),
+        self.algorithm, partial_hash, stat.st_dev, stat.st_ino, MtimeNs(stat))
+
+  def SaveHash(self, filename, stat, md5hash, partial_hash=None):
+    """Stores a freshly computed hash. Returns the file stats object, or None
+    if the hash could not be computed. A partial hash that is already in the
+    database for the same file contents is kept."""
     if not md5hash:
       return None
-    file_stats = FileStats(path, base_name, md5hash, size, timestamp_seconds)
+    if not partial_hash:
+      from_database = self.GetValidFileStats(filename, stat)
+      if from_database:
+        partial_hash = from_database.GetPartialHash()
+    file_stats = self.NewFileStats(filename, stat, md5hash, partial_hash)
     self.repository.Upsert(file_stats)
     return file_stats
 
-  def HashPathsToDatabase(self, paths):
-    self.tree_walker.Walk(paths, 'hash_to_database', self.HashFileToDatabase)
+  def GetPartialHash(self, filename, stat):
+    """Returns the partial hash of the file, from the database if possible.
+    Returns None if it could not be computed."""
+    from_database = self.GetValidFileStats(filename, stat)
+    if from_database and from_database.GetPartialHash():
+      return from_database.GetPartialHash()
+    partial_hash = HashFilePartial(
+        filename, self.console, stat.st_size, self.algorithm)
+    if not partial_hash:
+      return None
+    md5hash = None
+    if from_database:
+      md5hash = from_database.GetHash()
+    elif stat.st_size <= 2 * PARTIAL_HASH_BYTES:
+      # The partial hash covers the whole file.
+      md5hash = partial_hash
+    self.repository.Upsert(
+        self.NewFileStats(filename, stat, md5hash, partial_hash))
+    return partial_hash
+
+  def FindDuplicates(self, paths, verify=False):
+    """Prints groups of identical files found in paths. Files are compared
+    in stages, each stage only looking at the files that are still
+    candidates: first the size, then the partial hash, then the full hash
+    and, with verify, the bytes (see SplitIdenticalFiles). Empty files are
+    ignored."""
+    by_size = {}
+    for entry in self.WalkPaths(paths, 'find_duplicates'):
+      stat = entry.GetStat()
+      if stat.st_size:
+        by_size.setdefault(stat.st_size, []).append(
+            (entry.GetFilename(), stat))
+    candidates = [group for group in by_size.itervalues() if len(group) > 1]
+    by_size = None
+
+    by_partial_hash = {}
+    count = 0
+    for group in candidates:
+      for filename, stat in group:
+        count += 1
+        self.console.Flash('find_duplicates: partial hash %d: %s' % (
+            count, filename))
+        partial_hash = self.GetPartialHash(filename, stat)
+        if partial_hash:
+          key = (stat.st_size, partial_hash)
+          by_partial_hash.setdefault(key, []).append((filename, stat))
+    candidates = [
+        group for group in by_partial_hash.itervalues() if len(group) > 1]
+    by_partial_hash = None
+
+    duplicates = []
+    count = 0
+    for group in candidates:
+      size = group[0][1].st_size
+      by_hash = {}
+      for filename, stat in group:
+        count += 1
+        self.console.Flash('find_duplicates: full hash %d: %s' % (
+            count, filename))
+        file_stats = self.HashFileToDatabase(filename, stat)
+        if file_stats:
+          by_hash.setdefault(file_stats.GetHash(), []).append(filename)
+      stats = dict(group)
+      for filenames in by_hash.itervalues():
+        if len(filenames) < 2:
+          continue
+        if verify:
+          groups = SplitIdenticalFiles(sorted(filenames), self.console)
+        else:
+          groups = [sorted(filenames)]
+        for filenames in groups:
+          # Hard links to the same file reclaim nothing.
+          files = DistinctFileCount(
+              (stats[filename].st_dev, stats[filename].st_ino)
+              for filename in filenames)
+          duplicates.append((size * (files - 1), filenames))
+
+    # Most reclaimable bytes first.
+    duplicates.sort(key=lambda (reclaimable, filenames): -reclaimable)
+    wasted = 0
+    for reclaimable, filenames in duplicates:
+      wasted += reclaimable
+      for filename in filenames:
+        self.console.Print(filename)
+      self.console.Print()
+    self.console.Print('%d groups of duplicates, %d bytes reclaimable' % (
+        len(duplicates), wasted))
+
+  def WalkPaths(self, paths, name, directories=None, resume=None):
+    """Walks paths; the number of files that the database holds for them is
+    used as the expected count, less those done before resume."""
+    expected_count = self.repository.CountFiles(AbsolutePaths(paths))
+    if resume:
+      expected_count = max(expected_count - resume.GetFiles(), 0)
+    if self.metrics:
+      self.metrics.expected_files = expected_count
+    return self.tree_walker.Walk(
+        paths, name, expected_count, directories, resume)
+
+  def StartMetrics(self, name, expected_files=0):
+    """Starts the ScanMetrics of a scan, shown by the console."""
+    self.metrics = ScanMetrics(
+        name, expected_files, self.metrics_output, self.metrics_seconds)
+    self.console.SetMetrics(self.metrics)
+
+  def FinishMetrics(self):
+    """Writes the final metrics of the scan and prints a summary."""
+    self.console.SetMetrics(None)
+    self.metrics.Write(done=True)
+    metrics = self.metrics.Get()
+    self.console.Print(
+        '%s: %d files in %.1fs (%d cached, %d hashed), %.0f files/s, '
+        '%.1f MB/s' % (
+            metrics['name'], metrics['files'], metrics['elapsed_seconds'],
+            metrics['cached_files'], metrics['hashed_files'],
+            metrics['files_per_second'], metrics['mb_per_second']))
+    self.metrics = None
+
+  def HashPathsToDatabase(self, paths, jobs=1, full=False,
+                          disk_order_window=0, resume=False):
+    """Hashes the files under paths into the database. Unless full is set,
+    the files of directories that did not change since the previous run are
+    skipped (see IncrementalScan). With a disk_order_window, the files to
+    hash are reordered by their location on disk (see DiskOrderScheduler).
+
+    The position of the run is saved with each batch (see ScanCheckpoint),
+    and deleted once all paths are walked. With resume, the run continues
+    from the checkpoint of the same paths, or of the most recent run if no
+    paths are given; files that changed in the directories that it skips
+    are left for the next run."""
+    resume_from = None
+    if resume:
+      roots = None
+      if paths:
+        roots = AbsolutePaths(paths)
+      resume_from = self.repository.GetCheckpoint(roots)
+      if resume_from is None:
+        if not paths:
+          self.console.Error('No hash_to_database checkpoint to resume')
+          return None
+        self.console.Print('No checkpoint for these paths, starting over')
+      elif resume_from.GetAlgorithm() != self.algorithm:
+        self.console.Error('The checkpoint is for --hash_algorithm %s' % (
+            resume_from.GetAlgorithm()))
+        return None
+      else:
+        paths = resume_from.GetRoots()
+        full = resume_from.IsFull()
+        self.console.Print(
+            'Resuming hash_to_database of %s after %d files, %d directories'
+            % (', '.join(paths), resume_from.GetFiles(),
+               resume_from.GetDirectories()))
+    checkpoint = resume_from
+    if checkpoint is None:
+      checkpoint = ScanCheckpoint(AbsolutePaths(paths), self.algorithm, full)
+    try:
+      self.repository.SetCheckpoint(checkpoint)
+    except UnicodeDecodeError:
+      checkpoint = None  # Not an utf8 path, no checkpoint.
+    scan = IncrementalScan(self.repository, self.algorithm, full, checkpoint)
+    self.StartMetrics('hash_to_database')
+    try:
+      files = self.FilesToHash(
+          self.WalkPaths(paths, 'hash_to_database', scan, resume_from), scan)
+      fadvise = disk_order_window > 0
+      if fadvise:
+        files = DiskOrderScheduler(disk_order_window).Order(files)
+      if jobs <= 1:
+        for filename, stat in files:
+          md5hash = HashFile(filename, self.console, self.algorithm, fadvise)
+          self.SaveHashed(scan, filename, stat, md5hash)
+      else:
+        pool = HashWorkerPool(
+            jobs, self.console, self.algorithm, fadvise=fadvise)
+        for filename, stat in files:
+          pool.Submit(filename, stat)
+          for filename, stat, md5hash in pool.Results():
+            self.SaveHashed(scan, filename, stat, md5hash)
+        for filename, stat, md5hash in pool.Close():
+          self.console.Flash('hash_to_database: %d files left to hash: %s' % (
+              pool.pending_count, filename))
+          self.SaveHashed(scan, filename, stat, md5hash)
+      scan.Finish()
+    finally:
+      self.FinishMetrics()
+
+  def SaveHashed(self, scan, filename, stat, md5hash):
+    """Saves a hash computed for --hash_to_database."""
+    file_stats = self.SaveHash(filename, stat, md5hash)
+    scan.FileDone(filename, file_stats is not None)
+    self.metrics.FileHashed(stat.st_size)
+
+  def HashPathsPerDevice(self, paths, device_concurrency, full=False,
+                         disk_order_window=0):
+    """Like HashPathsToDatabase, but the paths are grouped by device and all
+    devices are scanned at the same time, each with the number of hashing
+    threads given by device_concurrency (a DeviceConcurrency). Only the
+    calling thread writes to the database."""
+    by_device = {}
+    for path in paths:
+      try:
+        st_dev = os.stat(path).st_dev
+      except OSError:
+        st_dev = None  # The walker reports the error.
+      by_device.setdefault(st_dev, []).append(path)
+    # Lanes read the database through their own connections.
+    self.repository.Flush()
+    scan = IncrementalScan(self.repository, self.algorithm, full)
+    self.StartMetrics('hash_to_database',
+                      self.repository.CountFiles(AbsolutePaths(paths)))
+    try:
+      self.RunLanes(by_device, device_concurrency, scan, full,
+                    disk_order_window)
+    finally:
+      self.FinishMetrics()
+
+  def RunLanes(self, by_device, device_concurrency, scan, full,
+               disk_order_window):
+    """Runs a DeviceLane per device of by_device ({st_dev: paths}) and
+    applies their events until all of them are finished."""
+    events = Queue.Queue(10000)
+    lanes = []
+    for st_dev, device_paths in sorted(by_device.iteritems()):
+      jobs = 1
+      if st_dev is not None:
+        jobs = device_concurrency.GetJobs(st_dev)
+      lanes.append(DeviceLane(
+          self, device_paths, jobs, events, full, disk_order_window))
+    for lane in lanes:
+      lane.Start()
+    running = len(lanes)
+    while running:
+      try:
+        # A timeout keeps the main thread responsive to KeyboardInterrupt.
+        event = events.get(True, 1)
+      except Queue.Empty:
+        continue
+      kind = event[0]
+      if kind == 'directory':
+        scan.DirectoryWalked(event[1])
+      elif kind == 'submitted':
+        scan.FileSubmitted(event[1])
+      elif kind == 'done':
+        # Only sent by FilesToHash, for files that need no hashing.
+        scan.FileDone(event[1], event[2])
+        self.metrics.FileCached()
+      elif kind == 'upsert':
+        self.repository.Upsert(event[1])
+      elif kind == 'hashed':
+        self.SaveHashed(scan, *event[1:])
+      elif kind == 'finished':
+        running -= 1
+        lane, exc_info = event[1:]
+        lane.thread.join()
+        if exc_info:
+          raise exc_info[0], exc_info[1], exc_info[2]
+
+  def IndexChunks(self, min_file_size):
+    """Splits the files of the database of at least min_file_size bytes into
+    content-defined chunks and stores them, once per distinct content.
+    Smaller files are only compared by their whole-file hash."""
+    count = 0
+    for md5hash, group in self.repository.FilesToChunk(
+        min_file_size, self.algorithm):
+      for file_stats in group:
+        filename = os.path.join(file_stats.GetPath(), file_stats.GetBaseName())
+        count += 1
+        self.console.Flash('chunk_index: file %d: %s' % (count, filename))
+        chunks = self.ChunkHashedFile(filename, file_stats)
+        if chunks is not None:
+          self.repository.AddChunks(md5hash, self.algorithm, chunks)
+          break
+
+  def ChunkHashedFile(self, filename, file_stats):
+    """Returns the chunks of the file, or None if it could not be read or no
+    longer has the content of file_stats."""
+    file_hasher = HASH_ALGORITHMS[self.algorithm]()
+    try:
+      stat = os.stat(filename)
+      if (stat.st_size != file_stats.GetSize()
+          or int(stat.st_mtime) != file_stats.GetTimestampSeconds()):
+        return None
+      f = open(filename, 'rb')
+      try:
+        chunks = list(ChunkFile(f, self.algorithm, file_hasher))
+      finally:
+        f.close()
+    except (IOError, OSError), e:
+      self.console.Error('Could not chunk %s: %s' % (filename, e.strerror))
+      return None
+    if file_hasher.hexdigest() != file_stats.GetHash():
+      self.console.Error('%s changed since it was hashed' % filename)
+      return None
+    return chunks
+
+  def ReportSharedChunks(self, output, report_format='ndjson'):
+    """Writes the pairs of files that share chunks (see IndexChunks) to
+    output ('-' for stdout), the most shared bytes first: as ndjson, one
+    object per pair; as csv, one row per file."""
+    f = OpenOutput(output)
+    if report_format == 'csv':
+      writer = csv.writer(f)
+      writer.writerow(['pair', 'shared_bytes', 'hash', 'size', 'path'])
+    pair_count = 0
+    for hash_a, hash_b, shared in self.repository.SharedChunkPairs(
+        self.algorithm):
+      pair_count += 1
+      files = []
+      for md5hash in (hash_a, hash_b):
+        group = self.repository.FilesWithHash(md5hash, self.algorithm)
+        if group:
+          files.append({
+              'hash': md5hash,
+              'size': group[0].GetSize(),
+              'paths': [os.path.join(file_stats.GetPath(),
+                                     file_stats.GetBaseName())
+                        for file_stats in group]})
+      if report_format == 'csv':
+        for file_info in files:
+          for path in file_info['paths']:
+            writer.writerow([pair_count, shared, file_info['hash'],
+                             file_info['size'], path.encode('utf8')])
+      else:
+        f.write(json.dumps({'shared_bytes': shared, 'files': files}) + '\n')
+    if f is not sys.stdout:
+      f.close()
+    self.console.Print('%d pairs of files with shared chunks' % pair_count)
 
-  def Lookup(self, paths):
-    self.tree_walker.Walk(paths, 'lookup', self.LookupFile)
+  def FilesToHash(self, entries, scan):
+    """Yields (filename, stat) for the walked files whose hash is not in the
+    database. Directories and cached files are reported to scan right
+    away. Files whose inode was already hashed under another path (see
+    GetSameFileStats) get that hash without being read."""
+    for entry in entries:
+      if entry.IsDirectory():
+        scan.DirectoryWalked(entry)
+        continue
+      filename = entry.GetFilename()
+      stat = entry.GetStat()
+      scan.FileSubmitted(filename)
+      if self.GetCachedFileStats(filename, stat):
+        scan.FileDone(filename, True)
+        if self.metrics:
+          self.metrics.FileCached()
+        continue
+      same_file = self.GetSameFileStats(stat)
+      if same_file:
+        file_stats = self.SaveHash(filename, stat, same_file.GetHash(),
+                                   same_file.GetPartialHash())
+        scan.FileDone(filename, file_stats is not None)
+        if self.metrics:
+          self.metrics.FileCached()
+        continue
+      yield filename, stat
+
+  def Lookup(self, paths, bulk=False):
+    if bulk:
+      self.BulkLookup(paths)
+      return
+    for entry in self.WalkPaths(paths, 'lookup'):
+      self.LookupFile(entry.GetFilename(), entry.GetStat())
+
+  def BulkLookup(self, paths):
+    """Same output as Lookup, but all matches are fetched with one query once
+    every file has been hashed."""
+    self.repository.CreateLookupTable()
+    rows = []
+    for entry in self.WalkPaths(paths, 'lookup'):
+      file_stats = self.HashFileToDatabase(
+          entry.GetFilename(), entry.GetStat())
+      if file_stats:
+        rows.append((entry.GetFilename(), file_stats.GetHash(),
+                     file_stats.GetSize(), file_stats.GetAlgorithm()))
+      if len(rows) >= 1000:
+        self.repository.AddLookupFiles(rows)
+        rows = []
+    self.repository.AddLookupFiles(rows)
+    previous_filename = None
+    for filename, file_stats in self.repository.LookupAll():
+      if previous_filename is not None and filename != previous_filename:
+        self.console.Print()
+      previous_filename = filename
+      self.console.Print(os.path.join(
+        file_stats.GetPath(), file_stats.GetBaseName()))
+    if previous_filename is not None:
+      self.console.Print()
 
-  def LookupFile(self, filename):
-    file_stats = self.HashFileToDatabase(filename)
-    matches = self.repository.Lookup(file_stats.GetHash(), file_stats.GetSize())
+  def ReportDuplicates(self, output, report_format='ndjson'):
+    """Writes every group of duplicates of the database to output ('-' for
+    stdout), the most reclaimable bytes first. Groups are streamed: as
+    ndjson, one object per group; as csv, one row per file."""
+    f = OpenOutput(output)
+    if report_format == 'csv':
+      writer = csv.writer(f)
+      writer.writerow(['group', 'algorithm', 'hash', 'size', 'count',
+                       'wasted_bytes', 'path'])
+    group_count = 0
+    total_wasted = 0
+    for group in self.repository.DuplicateGroups():
+      group_count += 1
+      first = group[0]
+      # Hard links to the same file reclaim nothing.
+      wasted = first.GetSize() * (DistinctFileCount(
+          (file_stats.GetDevice(), file_stats.GetInode())
+          for file_stats in group) - 1)
+      total_wasted += wasted
+      paths = [os.path.join(file_stats.GetPath(), file_stats.GetBaseName())
+               for file_stats in group]
+      if report_format == 'csv':
+        for path in paths:
+          writer.writerow([
+              group_count, first.GetAlgorithm(), first.GetHash(),
+              first.GetSize(), len(group), wasted, path.encode('utf8')])
+      else:
+        f.write(json.dumps({
+            'algorithm': first.GetAlgorithm(),
+            'hash': first.GetHash(),
+            'size': first.GetSize(),
+            'count': len(group),
+            'wasted_bytes': wasted,
+            'paths': paths}) + '\n')
+    if f is not sys.stdout:
+      f.close()
+    self.console.Print('%d groups of duplicates, %d bytes reclaimable' % (
+        group_count, total_wasted))
+
+  def Export(self, output, host, volume):
+    """Writes every hashed file of the database to output as an export (see
+    WriteExport), tagged with host and volume."""
+    count = WriteExport(
+        output,
+        ((md5hash, size, algorithm, host, volume, path, timestamp_seconds)
+         for md5hash, size, algorithm, path, timestamp_seconds
+         in self.repository.ExportRows()),
+        {'host': host, 'volume': volume})
+    self.console.Print('Exported %d files to %s' % (count, output))
+
+  def MergeExports(self, exports, merged_output=None, report_output=None,
+                   report_format='ndjson'):
+    """Merges exports (see MergeExports) into merged_output, an export
+    that holds the rows of all of them, if given. Groups of files with the
+    same hash and size on more than one host are written to report_output
+    if given, in hash order: as ndjson, one object per group; as csv, one
+    row per file. A file found in several exports (same host, volume and
+    path) is only kept once. Memory use is bounded by the largest group."""
+    if report_output:
+      f = OpenOutput(report_output)
+      if report_format == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(['group', 'algorithm', 'hash', 'size', 'count',
+                         'wasted_bytes', 'host', 'volume', 'path'])
+    counts = {'rows': 0, 'groups': 0, 'wasted': 0}
+
+    def Rows():
+      for key, group in itertools.groupby(
+          MergeExports(exports), lambda row: row[:3]):
+        files = set()
+        unique = []
+        for row in group:
+          if row[3:6] not in files:
+            files.add(row[3:6])
+            unique.append(row)
+        group = unique
+        counts['rows'] += len(group)
+        hosts = sorted(set(row[3] for row in group))
+        if len(hosts) > 1:
+          md5hash, size, algorithm = key
+          wasted = size * (len(group) - 1)
+          counts['groups'] += 1
+          counts['wasted'] += wasted
+          if report_output and report_format == 'csv':
+            for row in group:
+              writer.writerow([
+                  counts['groups'], algorithm, md5hash, size, len(group),
+                  wasted] + [value.encode('utf8') for value in row[3:6]])
+          elif report_output:
+            f.write(json.dumps({
+                'algorithm': algorithm,
+                'hash': md5hash,
+                'size': size,
+                'count': len(group),
+                'wasted_bytes': wasted,
+                'hosts': hosts,
+                'files': [{'host': row[3], 'volume': row[4], 'path': row[5]}
+                          for row in group]}) + '\n')
+        for row in group:
+          yield row
+    if merged_output:
+      WriteExport(merged_output, Rows(), {'merged_from': len(exports)})
+    else:
+      for row in Rows():
+        pass
+    if report_output and f is not sys.stdout:
+      f.close()
+    self.console.Print(
+        'Merged %d files of %d exports: %d groups of duplicates across '
+        'hosts, %d bytes reclaimable' % (
+            counts['rows'], len(exports), counts['groups'],
+            counts['wasted']))
+
+  def LookupFile(self, filename, stat=None):
+    """Prints the files of the database with the same hash and size as
+    filename, which is first saved to the database, so it is one of them.
+    A file that was not in the database is checked against the hash filter
+    of the repository before it is saved: the database is only queried if
+    another file may match."""
+    if stat is None:
+      stat = os.stat(filename)
+    file_stats = self.GetCachedFileStats(filename, stat)
+    may_match = True
+    if not file_stats:
+      md5hash, partial_hash = self.HashUncachedFile(filename, stat)
+      if not md5hash:
+        return
+      may_match = self.repository.MayContain(md5hash, stat.st_size)
+      file_stats = self.SaveHash(filename, stat, md5hash, partial_hash)
+    if may_match:
+      matches = self.repository.Lookup(
+          file_stats.GetHash(), file_stats.GetSize(),
+          file_stats.GetAlgorithm())
+    else:
+      matches = [file_stats]
     for other_file_stats in matches:
       self.console.Print(os.path.join(
         other_file_stats.GetPath(), other_file_stats.GetBaseName()))
     self.console.Print()
 
+  def Prune(self, batch_size=10000):
+    """Deletes the rows of files and directories that no longer exist. The
+    catalog is read batch_size rows at a time, in path order, so each
+    directory is listed once, and dead rows are deleted batch_size at a
+    time."""
+    dead_files = []
+    file_count = 0
+    dead_file_count = 0
+    listed_path = None
+    names = None
+    path, base_name = '', ''
+    while True:
+      keys = self.repository.GetFileKeysAfter(path, base_name, batch_size)
+      if not keys:
+        break
+      for path, base_name in keys:
+        if path != listed_path:
+          listed_path = path
+          names = self.ListFileNames(path)
+          self.console.Flash('prune: file %d, %d dead: %s' % (
+              file_count, dead_file_count, path))
+        file_count += 1
+        if names is not None and base_name not in names:
+          dead_files.append((path, base_name))
+          dead_file_count += 1
+      if len(dead_files) >= batch_size:
+        self.repository.DeleteRows(dead_files)
+        dead_files = []
+    dead_directories = []
+    directory_path = ''
+    while True:
+      paths = self.repository.GetDirectoryPathsAfter(
+          directory_path, batch_size)
+      if not paths:
+        break
+      for directory_path in paths:
+        if not os.path.isdir(directory_path):
+          dead_directories.append(directory_path)
+    self.repository.DeleteRows(dead_files, dead_directories)
+    self.console.Print(
+        'Pruned %d of %d files and %d directories' % (
+            dead_file_count, file_count, len(dead_directories)))
+
+  def ListFileNames(self, directory):
+    """Returns the set of names of the files in directory, empty if it no
+    longer exists, or None if it cannot be listed."""
+    try:
+      entries = ScanDirectory(directory)
+    except OSError, e:
+      if e.errno in (errno.ENOENT, errno.ENOTDIR):
+        return set()
+      self.console.Error('Could not list %s: %s' % (directory, e.strerror))
+      return None
+    names = set()
+    for entry in entries:
+      try:
+        if not entry.is_dir(follow_symlinks=False) and not entry.is_symlink():
+          names.add(entry.name)
+      except OSError:
+        continue
+    return names
+
   def NameLike(self, name_like):
     matches = self.repository.FilePathMatch(name_like)
     for file_stats in matches:
@@ -346,46 +3823,300 @@ class Dupes(object):
         file_stats.GetPath(), file_stats.GetBaseName()))
     self.console.Print()
 
+  def NameGlob(self, name_glob):
+    matches = self.repository.FilePathGlob(name_glob)
+    for file_stats in matches:
+      self.console.Print(os.path.join(
+        file_stats.GetPath(), file_stats.GetBaseName()))
+    self.console.Print()
+
+
+class LaneDupes(Dupes):
+  """The Dupes of a DeviceLane, whose repository is read-only: rows are sent
+  to the events queue of the lane instead."""
+
+  def __init__(self, repository, tree_walker, console, algorithm, events):
+    Dupes.__init__(self, repository, tree_walker, console, algorithm)
+    self.events = events
+
+  def SaveHash(self, filename, stat, md5hash, partial_hash=None):
+    if not md5hash:
+      return None
+    file_stats = self.NewFileStats(filename, stat, md5hash, partial_hash)
+    self.events.put(('upsert', file_stats))
+    return file_stats
+
 
 def Main(args):
+  output = ConsoleOutput(args)
   if GetConsoleWidth() is None:
-    console = RedirectedConsole()
+    console = RedirectedConsole(output)
   else:
-    console = InteractiveConsole()
+    console = InteractiveConsole(output)
   database = os.path.expanduser(args.database)
-  repository = FileStatsRepository(database)
+  batch_size = args.batch_size
+  if args.commit_every_row:
+    batch_size = 1
+  repository = FileStatsRepository(
+      database, batch_size, args.batch_seconds, args.synchronous,
+      args.cache_size)
   repository.CreateTable()
-  tree_walker = TreeWalker(console)
-  dupes = Dupes(repository, tree_walker, console)
-  if args.hash_to_database:
-    dupes.HashPathsToDatabase(args.hash_to_database)
-  if args.lookup:
-    dupes.Lookup(args.lookup)
-  if args.name_like:
-    dupes.NameLike(args.name_like)
-  repository.Close()
+  profiler = None
+  if args.profile or args.profile_output:
+    profiler = PhaseProfiler()
+    module = sys.modules[__name__]
+    profiler.Instrument(module, 'ScanDirectory', 'ScanDirectory')
+    profiler.Instrument(module, 'StatEntry', 'stat')
+    profiler.Instrument(repository, 'Get', 'repository.Get')
+    profiler.Instrument(module, 'HashFile', 'HashFile')
+    profiler.Instrument(module, 'HashFilePartial', 'HashFilePartial')
+    profiler.Instrument(repository, 'Upsert', 'repository.Upsert')
+    profiler.Instrument(repository, 'Flush', 'repository.Flush')
+  python_profiler = None
+  if args.profile_output:
+    python_profiler = cProfile.Profile()
+    python_profiler.enable()
+  exclusion_rules = ExclusionRules(DEFAULT_EXCLUSION_RULES)
+  exclude_file = os.path.expanduser(args.exclude_file)
+  if os.path.exists(exclude_file):
+    exclusion_rules.AddFile(exclude_file)
+  exclusion_rules.AddRules(args.exclude or [])
+  tree_walker = TreeWalker(console, exclusion_rules)
+  metrics_output = None
+  if args.metrics_output:
+    metrics_output = open(args.metrics_output, 'a')
+  elif args.metrics_fd is not None:
+    metrics_output = os.fdopen(args.metrics_fd, 'a')
+  dupes = Dupes(repository, tree_walker, console, args.hash_algorithm,
+                metrics_output, args.metrics_seconds)
+  try:
+    if args.hash_to_database or args.resume:
+      disk_order_window = 0
+      if args.disk_order:
+        disk_order_window = args.disk_order_window
+      if args.per_device and args.resume:
+        console.Error('--resume does not support --per_device')
+      elif args.per_device:
+        dupes.HashPathsPerDevice(
+            args.hash_to_database,
+            DeviceConcurrency(args.hdd_jobs, args.ssd_jobs, args.jobs),
+            args.full, disk_order_window)
+      else:
+        dupes.HashPathsToDatabase(args.hash_to_database or [], args.jobs,
+                                  args.full, disk_order_window, args.resume)
+    if args.chunk_index:
+      dupes.IndexChunks(args.chunk_min_file_size)
+    if args.report_shared_chunks:
+      dupes.ReportSharedChunks(args.report_shared_chunks, args.report_format)
+    if args.lookup:
+      dupes.Lookup(args.lookup, args.bulk_lookup)
+    if args.name_like:
+      dupes.NameLike(args.name_like)
+    if args.name_glob:
+      dupes.NameGlob(args.name_glob)
+    if args.prune:
+      dupes.Prune()
+    if args.vacuum:
+      repository.Vacuum()
+    if args.find_duplicates:
+      dupes.FindDuplicates(args.find_duplicates, args.verify)
+    if args.report_duplicates:
+      dupes.ReportDuplicates(args.report_duplicates, args.report_format)
+    if args.export:
+      dupes.Export(args.export, args.host, args.volume)
+    if args.merge_exports:
+      dupes.MergeExports(args.merge_exports, args.merged_export,
+                         args.report_cross_host, args.report_format)
+    if args.dedupe:
+      Deduper(dupes, args.allow_hardlink, args.dry_run).Run()
+    if args.watch:
+      WatchDaemon(dupes, args.watch, args.debounce_seconds).Run()
+  finally:
+    # Also saves the pending batch when interrupted.
+    repository.Close()
+    if metrics_output:
+      metrics_output.close()
+    if python_profiler:
+      python_profiler.disable()
+      python_profiler.dump_stats(args.profile_output)
+    if profiler:
+      profiler.Report(console)
   console.Print('Updates saved to %s' % database)
 
 
 if __name__ == "__main__":
-  print 'HOME = %s' % os.environ['HOME']
-  print '~ = %s' % os.path.expanduser('~')
   parser = argparse.ArgumentParser(
       description='Find duplicate files',
       formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument('--database', metavar='path', nargs='?',
       default='~/.dupes/dupes.db',
       help='the path to the sqlite database file')
+  parser.add_argument('--hash_algorithm', choices=sorted(HASH_ALGORITHMS),
+      default='md5',
+      help='the hash algorithm used for files that are not yet in the '
+      'database with that algorithm; it is recorded with each file')
+  parser.add_argument('--exclude_file', metavar='path',
+      default='~/.dupes/exclude',
+      help='gitignore-style rules of files and directories to skip, one per '
+      'line, if the file exists (see ExclusionRules); excluded directories '
+      'are not entered. They follow the default rules: %s' %
+          ' '.join(DEFAULT_EXCLUSION_RULES))
+  parser.add_argument('--exclude', metavar='rule', action='append',
+      help='a rule to add after those of --exclude_file, e.g. node_modules/ '
+      'or !*.swp; may be repeated')
   parser.add_argument('--hash_to_database', metavar='path', nargs='*',
       help='a search path that should be explored; hashes will be computed '
       'and added to the database')
+  parser.add_argument('--full', action='store_true',
+      help='with --hash_to_database, also check the files of directories '
+      'whose mtime and number of entries did not change since the previous '
+      'run; those are skipped by default. Only a full run notices files '
+      'that were rewritten in place')
+  parser.add_argument('--resume', action='store_true',
+      help='continue the --hash_to_database run of the same paths, or of '
+      'the most recent run if no paths are given, from where it was '
+      'interrupted: directories that it finished are not walked again')
+  parser.add_argument('--jobs', metavar='N', type=int, default=1,
+      help='number of threads hashing files for --hash_to_database; the '
+      'database is still written by a single thread')
+  parser.add_argument('--per_device', action='store_true',
+      help='with --hash_to_database, group the paths by device and scan all '
+      'devices at the same time, each with its own number of hashing '
+      'threads: --hdd_jobs for rotational disks, --ssd_jobs for other block '
+      'devices (from /sys/block/*/queue/rotational) and --jobs otherwise')
+  parser.add_argument('--hdd_jobs', metavar='N', type=int, default=1,
+      help='with --per_device, hashing threads per rotational disk')
+  parser.add_argument('--ssd_jobs', metavar='N', type=int, default=8,
+      help='with --per_device, hashing threads per non-rotational device')
+  parser.add_argument('--disk_order', action='store_true',
+      help='with --hash_to_database, hash files in the order of their '
+      'location on disk (extent offset where FIEMAP is supported, inode '
+      'number otherwise) rather than in directory order, and give the kernel '
+      'read-ahead and drop-behind hints; this cuts seeks on spinning disks')
+  parser.add_argument('--disk_order_window', metavar='files', type=int,
+      default=1000,
+      help='with --disk_order, number of files that are sorted together')
+  parser.add_argument('--metrics_output', metavar='path',
+      help='with --hash_to_database, append the scan metrics (files/s, '
+      'MB/s, cache hit ratio, ETA) to this file as one json object per line, '
+      'every --metrics_seconds and at the end of the scan')
+  parser.add_argument('--metrics_fd', metavar='N', type=int,
+      help='like --metrics_output, to an open file descriptor')
+  parser.add_argument('--metrics_seconds', metavar='seconds', type=float,
+      default=10,
+      help='interval between two writes of --metrics_output')
+  parser.add_argument('--batch_size', metavar='rows', type=int, default=1000,
+      help='database writes are grouped in transactions of up to this many '
+      'rows; an interrupted run loses at most one batch')
+  parser.add_argument('--batch_seconds', metavar='seconds', type=float,
+      default=5,
+      help='pending database writes are committed at least this often')
+  parser.add_argument('--commit_every_row', action='store_true',
+      help='commit each row on its own instead of batching')
+  parser.add_argument('--synchronous', choices=['OFF', 'NORMAL', 'FULL'],
+      default='NORMAL',
+      help='sqlite synchronous pragma; with NORMAL, a power loss may also '
+      'roll back the last committed batches')
+  parser.add_argument('--cache_size', metavar='N', type=int, default=-65536,
+      help='sqlite cache_size pragma: pages if positive, KiB if negative')
+  parser.add_argument('--profile', action='store_true',
+      help='time the directory listings, os.lstat, database reads and '
+      'writes and hashing, and print the count, total time and latency '
+      'percentiles of each at exit. Only the database of the main thread is '
+      'timed, not the read-only ones of --per_device')
+  parser.add_argument('--profile_output', metavar='path',
+      help='implies --profile; also run cProfile on the main thread and '
+      'write its pstats to this file')
   parser.add_argument('--lookup', metavar='path', nargs='*',
       help='a search path that should be explored; all files that match the '
       'hashes and sizes from the search path will be returned')
+  parser.add_argument('--bulk_lookup', action='store_true',
+      help='with --lookup, hash all files first, then fetch every match with '
+      'a single query')
+  parser.add_argument('--report_duplicates', metavar='path',
+      help='write all groups of duplicates of the database to this file (- '
+      'for stdout), the most reclaimable bytes first')
+  parser.add_argument('--report_format', choices=['ndjson', 'csv'],
+      default='ndjson',
+      help='format of --report_duplicates, --report_shared_chunks and '
+      '--report_cross_host: one json object per group or pair, or one csv '
+      'row per file')
+  parser.add_argument('--export', metavar='path',
+      help='write the hashed files of the database to this file (- for '
+      'stdout), sorted by hash and gzip-compressed, tagged with --host and '
+      '--volume, for --merge_exports on another host')
+  parser.add_argument('--host', metavar='name', default=socket.gethostname(),
+      help='with --export, the host of the files')
+  parser.add_argument('--volume', metavar='name', default='',
+      help='with --export, the volume of the files, e.g. a share name')
+  parser.add_argument('--merge_exports', metavar='path', nargs='+',
+      help='merge files written by --export (or --merged_export) in a '
+      'single pass of bounded memory, and report the groups of duplicates '
+      'found on more than one host')
+  parser.add_argument('--merged_export', metavar='path',
+      help='with --merge_exports, write all their files to this export')
+  parser.add_argument('--report_cross_host', metavar='path',
+      help='with --merge_exports, write the groups of duplicates found on '
+      'more than one host to this file (- for stdout), in hash order')
+  parser.add_argument('--chunk_index', action='store_true',
+      help='split the files of the database of at least '
+      '--chunk_min_file_size bytes into content-defined chunks (about 1 MiB '
+      'each) and store their hashes, so that files that are only partly '
+      'identical can be found; each content is only read once')
+  parser.add_argument('--chunk_min_file_size', metavar='bytes', type=int,
+      default=64 << 20,
+      help='with --chunk_index, smaller files are left out')
+  parser.add_argument('--report_shared_chunks', metavar='path',
+      help='write the pairs of files that share chunks (see --chunk_index) to '
+      'this file (- for stdout), the most shared bytes first, in '
+      '--report_format')
+  parser.add_argument('--find_duplicates', metavar='path', nargs='*',
+      help='a search path that should be explored; prints the groups of '
+      'identical files found there. Only files of equal size get a partial '
+      'hash, and only files whose partial hashes collide get a full hash')
+  parser.add_argument('--dedupe', action='store_true',
+      help='reclaim the space used by the duplicates of the database: each '
+      'copy is compared byte by byte with the kept file of its group, then '
+      'atomically replaced by a reflink to it (btrfs, xfs). The file kept '
+      'is the oldest of the group (by mtime, then by path)')
+  parser.add_argument('--allow_hardlink', action='store_true',
+      help='with --dedupe, replace copies by hard links where reflinks are '
+      'not supported; the files then share their metadata and any later '
+      'change')
+  parser.add_argument('--dry_run', action='store_true',
+      help='with --dedupe, only print what would be replaced, without '
+      'writing anything; files are still compared byte by byte')
+  parser.add_argument('--prune', action='store_true',
+      help='delete the rows of files and directories that no longer exist; '
+      'the database is read in path order, 10000 rows at a time, so that '
+      'each directory is listed once')
+  parser.add_argument('--vacuum', action='store_true',
+      help='release the free pages of the database (freed pages are also '
+      'released after each --prune batch); the first time, a database '
+      'created by an older version is rewritten to enable this')
+  parser.add_argument('--verify', action='store_true',
+      help='with --find_duplicates, also compare the files of each group '
+      'byte by byte, reading each file once (--dedupe always does)')
+  parser.add_argument('--watch', metavar='path', nargs='*',
+      help='directories to keep in sync with the database: after an '
+      'incremental --hash_to_database pass, stays resident and rehashes '
+      'files as inotify reports changes (Linux only)')
+  parser.add_argument('--debounce_seconds', metavar='seconds', type=float,
+      default=2,
+      help='with --watch, a file is processed once it has had no event for '
+      'this long')
   parser.add_argument('--name_like', metavar='like_clause', nargs='?',
       help='find all files in repository whose full path matches the given '
       'sql LIKE clause; the search is not case-sensitive. There are two '
       'wildcard characters: the percent sign % represents zero, one or more '
       'characters, whereas the underscore _ represents a single character.')
+  parser.add_argument('--name_glob', metavar='glob', nargs='?',
+      help='find all files in repository whose full path matches the given '
+      'sql GLOB pattern; the search is case-sensitive. The wildcards are * '
+      'for any characters, ? for a single character and [...] for one '
+      'character of a set.')
   
-  Main(parser.parse_args())
+  args = parser.parse_args()
+  print >>ConsoleOutput(args), 'HOME = %s' % os.environ['HOME']
+  print >>ConsoleOutput(args), '~ = %s' % os.path.expanduser('~')
+  Main(args)
@@ -0,0 +1,638 @@
+#!/usr/bin/python
+"""Benchmarks for dupes2.py."""
+import argparse
+import collections
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import dupes2
+
+
+def MakeSmallFilesTree(root, file_count, file_size, files_per_directory=1000):
+  """Creates file_count files of file_size random bytes under root."""
+  for i in xrange(file_count):
+    directory = os.path.join(root, 'd%05d' % (i / files_per_directory))
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    f = open(os.path.join(directory, 'f%07d' % i), 'wb')
+    f.write(os.urandom(file_size))
+    f.close()
+
+
+def ListFiles(root):
+  result = []
+  for directory, folders, files in os.walk(root):
+    for filename in files:
+      result.append(os.path.join(directory, filename))
+  result.sort()
+  return result
+
+
+def BenchmarkHashFile(args):
+  root = tempfile.mkdtemp(prefix='dupes2_benchmark_', dir=args.tmp_dir)
+  try:
+    MakeSmallFilesTree(root, args.files, args.file_size)
+    filenames = ListFiles(root)
+    console = dupes2.RedirectedConsole()
+    hash_args = []
+    if args.algorithm:
+      hash_args = [args.algorithm]
+    # Warm the page cache so that only hashing is measured.
+    for filename in filenames:
+      dupes2.HashFile(filename, console, *hash_args)
+    start = time.time()
+    for filename in filenames:
+      dupes2.HashFile(filename, console, *hash_args)
+    elapsed = time.time() - start
+    print 'hash_file: algorithm=%s files=%d size=%d: %.2fs, %.0f files/s' % (
+        args.algorithm or 'default', len(filenames), args.file_size, elapsed,
+        len(filenames) / elapsed)
+  finally:
+    shutil.rmtree(root)
+
+
+def MakeCatalogRow(i):
+  """Returns a synthetic FileStats, 1000 files per directory."""
+  return dupes2.FileStats(
+      '/data/vol%d/dir%05d/sub%03d' % (i % 4, i / 100000, i / 1000 % 100),
+      'file%08d.jpg' % i, hashlib.md5(str(i)).hexdigest(), 1000 + i % 997,
+      1400000000 + i)
+
+
+def TimeQueries(name, function, arguments_list):
+  start = time.time()
+  result_count = 0
+  for arguments in arguments_list:
+    result_count += len(function(*arguments))
+  elapsed = time.time() - start
+  print '  %-34s %8.3f ms/query (%d queries, %d results)' % (
+      name, 1000 * elapsed / len(arguments_list), len(arguments_list),
+      result_count)
+
+
+def TimeSearchQueries(repository, rows):
+  samples = [MakeCatalogRow(random.randrange(rows)) for i in xrange(20)]
+  TimeQueries('Lookup', repository.Lookup,
+      [(s.GetHash(), s.GetSize()) for s in samples])
+  TimeQueries('FilePathMatch %/file0123456%', repository.FilePathMatch,
+      [('%%/%s%%' % s.GetBaseName()[:-4],) for s in samples[:5]])
+  TimeQueries('FilePathMatch %dir00004/sub042%', repository.FilePathMatch,
+      [('%dir00004/sub042%',)])
+  TimeQueries('FilePathGlob */file0123456.jpg', repository.FilePathGlob,
+      [('*/%s' % s.GetBaseName(),) for s in samples[:5]])
+
+
+# (method, pattern) whose results must not depend on the file_paths index.
+PATH_SEARCH_CHECKS = [
+  ('FilePathGlob', u'*/\xc9*'),
+  ('FilePathMatch', u'%/\xc9%'),
+  ('FilePathGlob', u'*/\xc9t\xe9*'),
+  ('FilePathGlob', u'*/[]a]*'),
+  ('FilePathGlob', u'*/[^]a]bc.txt'),
+  ('FilePathGlob', u'*/file*.jpg'),
+]
+
+def CheckPathSearch(root):
+  """Checks that FilePathMatch and FilePathGlob find the same paths with
+  and without the file_paths index, for PATH_SEARCH_CHECKS."""
+  repository = dupes2.FileStatsRepository(os.path.join(root, 'check.db'))
+  repository.CreateTable()
+  for i, base_name in enumerate([
+      u'\xc9t\xe9.txt', u'\xe9t\xe9.txt', u']bc.txt', u'abc.txt',
+      u'xbc.txt', u'file1.jpg']):
+    repository.Upsert(dupes2.FileStats(
+        u'/c', base_name, hashlib.md5(str(i)).hexdigest(), i, 0))
+  for method, pattern in PATH_SEARCH_CHECKS:
+    results = []
+    for has_path_index in (True, False):
+      repository.has_path_index = has_path_index
+      results.append(sorted(file_stats.GetBaseName() for file_stats in
+                            getattr(repository, method)(pattern)))
+    if results[0] != results[1]:
+      raise Exception('%s %r: %r with the index, %r without' % (
+          method, pattern, results[0], results[1]))
+    print 'path_search: %s %r: %d paths' % (
+        method, pattern, len(results[0]))
+  repository.Close()
+
+
+def BenchmarkPathSearch(args):
+  """Times Lookup, FilePathMatch and FilePathGlob on a catalog of
+  args.rows synthetic rows, before and after the (md5hash, size) index and
+  the file_paths trigram index are created."""
+  root = tempfile.mkdtemp(prefix='dupes2_benchmark_', dir=args.tmp_dir)
+  try:
+    CheckPathSearch(root)
+    database = os.path.join(root, 'dupes.db')
+    repository = dupes2.FileStatsRepository(database, batch_size=100000)
+    repository.CreateTable()
+    # The current schema, without the indexes that serve searches.
+    cursor = repository.connection.cursor()
+    for trigger in ('insert', 'delete', 'update'):
+      cursor.execute('DROP TRIGGER file_paths_%s' % trigger)
+    cursor.execute('DROP TABLE file_paths')
+    cursor.execute('DROP INDEX file_stats_hash_size')
+    repository.has_path_index = False
+    start = time.time()
+    for i in xrange(args.rows):
+      repository.Upsert(MakeCatalogRow(i))
+    repository.Flush()
+    repository.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    print 'path_search: rows=%d, inserted in %.1fs, %d MB' % (
+        args.rows, time.time() - start, os.path.getsize(database) >> 20)
+    print 'without indexes:'
+    TimeSearchQueries(repository, args.rows)
+    start = time.time()
+    cursor.execute('BEGIN')
+    for statement in dupes2.SCHEMA_UPGRADES[2]:
+      cursor.execute(statement)
+    dupes2.CreateDirectoryPathIndex(cursor)
+    cursor.execute('COMMIT')
+    repository.has_path_index = True
+    repository.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    print 'with indexes (built in %.1fs, %d MB):' % (
+        time.time() - start, os.path.getsize(database) >> 20)
+    TimeSearchQueries(repository, args.rows)
+    repository.Close()
+  finally:
+    shutil.rmtree(root)
+
+
+def CreateCatalogV7(database, rows):
+  """Creates a catalog of rows synthetic rows in the format that preceded
+  MigrateToDirectoryIds: full directory paths and hex digests."""
+  connection = sqlite3.connect(database, isolation_level=None)
+  connection.create_function('unhex', 1, dupes2.Unhex)
+  cursor = connection.cursor()
+  cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+  cursor.execute('PRAGMA journal_mode=WAL')
+  cursor.execute('PRAGMA recursive_triggers=ON')
+  cursor.execute('BEGIN')
+  cursor.execute(
+      'CREATE TABLE file_stats (path text, base_name text, '
+      'md5hash text, size integer, timestamp_seconds integer, '
+      'PRIMARY KEY (path, base_name))')
+  version = dupes2.SCHEMA_UPGRADES.index(dupes2.MigrateToDirectoryIds)
+  for upgrade in dupes2.SCHEMA_UPGRADES[:version]:
+    if callable(upgrade):
+      upgrade(cursor)
+    else:
+      for statement in upgrade:
+        cursor.execute(statement)
+  cursor.execute('PRAGMA user_version = %d' % version)
+  cursor.execute('COMMIT')
+  for start in xrange(0, rows, 100000):
+    cursor.execute('BEGIN')
+    cursor.executemany(
+        'INSERT INTO file_stats (path, base_name, md5hash, size, '
+        'timestamp_seconds) VALUES (?,?,?,?,?)',
+        [(s.GetPath(), s.GetBaseName(), s.GetHash(), s.GetSize(),
+          s.GetTimestampSeconds())
+         for s in (MakeCatalogRow(i)
+                   for i in xrange(start, min(start + 100000, rows)))])
+    cursor.execute('COMMIT')
+  cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+  return connection
+
+
+def FetchAll(connection, query):
+  """Returns a function that runs query and returns all its rows."""
+  def Run(*parameters):
+    return connection.execute(query, parameters).fetchall()
+  return Run
+
+
+def TimeDirectoryQueries(name, function, rows):
+  TimeQueries(name, function,
+      [(MakeCatalogRow(random.randrange(rows)).GetPath(),)
+       for i in xrange(100)])
+
+
+def BenchmarkMigrate(args):
+  """Builds a catalog of args.rows rows in the previous format, then times
+  the upgrade to dir_id and BLOB digests, with the size of the database and
+  the latency of directory loads and lookups before and after."""
+  root = tempfile.mkdtemp(prefix='dupes2_benchmark_', dir=args.tmp_dir)
+  try:
+    database = os.path.join(root, 'dupes.db')
+    start = time.time()
+    connection = CreateCatalogV7(database, args.rows)
+    print 'migrate: rows=%d, created in %.1fs, %d MB' % (
+        args.rows, time.time() - start, os.path.getsize(database) >> 20)
+    samples = [MakeCatalogRow(random.randrange(args.rows))
+               for i in xrange(100)]
+    TimeDirectoryQueries('directory (path text)', FetchAll(
+        connection, 'SELECT * FROM file_stats WHERE path=?'), args.rows)
+    TimeQueries('lookup (hex text)', FetchAll(
+        connection, 'SELECT * FROM file_stats WHERE md5hash=? AND size=?'),
+        [(s.GetHash(), s.GetSize()) for s in samples])
+    connection.close()
+    start = time.time()
+    repository = dupes2.FileStatsRepository(database)
+    repository.CreateTable()
+    elapsed = time.time() - start
+    repository.Vacuum()
+    repository.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    print 'upgraded in %.1fs, %d MB after --vacuum' % (
+        elapsed, os.path.getsize(database) >> 20)
+
+    TimeDirectoryQueries('directory (dir_id)', FetchAll(
+        repository.connection, 'SELECT * FROM %s WHERE d.path=?' %
+            dupes2.FILE_STATS_TABLES), args.rows)
+    TimeQueries('lookup (blob)', FetchAll(
+        repository.connection,
+        'SELECT * FROM %s WHERE f.md5hash=? AND f.size=?' %
+            dupes2.FILE_STATS_TABLES),
+        [(dupes2.DigestToBlob(s.GetHash()), s.GetSize()) for s in samples])
+
+    def LoadDirectory(path):
+      repository.directory_cache.clear()
+      repository.most_recent_directory = None
+      return repository.GetDirectoryFiles(path)
+    TimeDirectoryQueries('GetDirectoryFiles (dir_id)', LoadDirectory,
+                         args.rows)
+    TimeQueries('Lookup (blob)', repository.Lookup,
+        [(s.GetHash(), s.GetSize()) for s in samples])
+    repository.Close()
+  finally:
+    shutil.rmtree(root)
+
+
+def CheckHashFilterAlgorithms(keys=10000):
+  """Checks that a HashFilter holds the digests of every algorithm of
+  HASH_ALGORITHMS, with about the expected rate of false positives."""
+  for algorithm, hasher in sorted(dupes2.HASH_ALGORITHMS.iteritems()):
+    hash_filter = dupes2.HashFilter(keys)
+    added = [(hasher('added %d' % i).hexdigest(), i) for i in xrange(keys)]
+    for md5hash, size in added:
+      hash_filter.Add(md5hash, size)
+    if not all(hash_filter.MayContain(md5hash, size)
+               for md5hash, size in added):
+      raise Exception('HashFilter misses %s digests' % algorithm)
+    false_positives = sum(
+        hash_filter.MayContain(hasher('missing %d' % i).hexdigest(), i)
+        for i in xrange(keys))
+    print 'hash_filter: %s, false positives: %.2f%%' % (
+        algorithm, 100.0 * false_positives / keys)
+    if false_positives > keys * 0.05:
+      raise Exception('HashFilter has too many false positives for %s' % (
+          algorithm))
+
+
+def BenchmarkHashFilter(args):
+  """Times the queries of lookups without a match on a catalog of args.rows
+  synthetic rows, with and without the HashFilter, and building, saving and
+  loading the filter."""
+  CheckHashFilterAlgorithms()
+  root = tempfile.mkdtemp(prefix='dupes2_benchmark_', dir=args.tmp_dir)
+  try:
+    database = os.path.join(root, 'dupes.db')
+    repository = dupes2.FileStatsRepository(database, batch_size=100000)
+    repository.CreateTable()
+    for i in xrange(args.rows):
+      repository.Upsert(MakeCatalogRow(i))
+    repository.Flush()
+    start = time.time()
+    repository.RebuildHashFilter()
+    print 'hash_filter: rows=%d, built in %.2fs' % (
+        args.rows, time.time() - start)
+    start = time.time()
+    repository.Close()
+    filename = repository.GetHashFilterFilename()
+    print '  saved in %.2fs, %d KB' % (
+        time.time() - start, os.path.getsize(filename) >> 10)
+    start = time.time()
+    hash_filter = dupes2.LoadHashFilter(filename)
+    print '  loaded in %.3fs' % (time.time() - start)
+    repository = dupes2.FileStatsRepository(database)
+    repository.CreateTable()
+    misses = [(hashlib.md5('missing %d' % i).hexdigest(), 1000 + i % 997)
+              for i in xrange(10000)]
+    TimeQueries('Lookup (miss)', repository.Lookup, misses)
+    TimeQueries('MayContain (miss)', lambda md5hash, size: [
+        repository.MayContain(md5hash, size)] * 0, misses)
+    false_positives = sum(
+        hash_filter.MayContain(md5hash, size) for md5hash, size in misses)
+    print '  false positives: %.2f%%' % (100.0 * false_positives / len(misses))
+    repository.Close()
+  finally:
+    shutil.rmtree(root)
+
+
+def EvictFromPageCache(filenames):
+  """Drops the (clean) pages of the files from the page cache."""
+  for filename in filenames:
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+      dupes2.Fadvise(fd, 0, 0, dupes2.POSIX_FADV_DONTNEED)
+    finally:
+      os.close(fd)
+
+
+def TimeHashing(name, files, total_bytes, fadvise):
+  console = dupes2.RedirectedConsole()
+  start = time.time()
+  for filename, stat in files:
+    dupes2.HashFile(filename, console, 'md5', fadvise)
+  elapsed = time.time() - start
+  print '  %-12s %.2fs, %.1f MB/s' % (
+      name, elapsed, total_bytes / elapsed / (1 << 20))
+
+
+def BenchmarkDiskOrder(args):
+  """Hashes a tree with a cold page cache, in walk order and in the order of
+  DiskOrderScheduler. The files are written in random order, so that their
+  layout on disk does not follow the directory order."""
+  root = tempfile.mkdtemp(prefix='dupes2_benchmark_', dir=args.tmp_dir)
+  try:
+    indexes = range(args.files)
+    random.shuffle(indexes)
+    for i in indexes:
+      directory = os.path.join(root, 'd%05d' % (i / 1000))
+      if not os.path.exists(directory):
+        os.makedirs(directory)
+      f = open(os.path.join(directory, 'f%07d' % i), 'wb')
+      f.write(os.urandom(args.file_size))
+      f.close()
+    # Only clean pages can be evicted.
+    os.system('sync')
+    walker = dupes2.TreeWalker(dupes2.RedirectedConsole())
+    walk_order = [(entry.GetFilename(), entry.GetStat())
+                  for entry in walker.Walk([root], 'disk_order')]
+    total_bytes = sum(stat.st_size for filename, stat in walk_order)
+    print 'disk_order: files=%d size=%d, cold page cache:' % (
+        len(walk_order), args.file_size)
+    EvictFromPageCache([filename for filename, stat in walk_order])
+    TimeHashing('walk order', walk_order, total_bytes, False)
+    EvictFromPageCache([filename for filename, stat in walk_order])
+    start = time.time()
+    disk_order = list(dupes2.DiskOrderScheduler().Order(walk_order))
+    EvictFromPageCache([filename for filename, stat in walk_order])
+    print '  (sorted in %.2fs)' % (time.time() - start)
+    TimeHashing('disk order', disk_order, total_bytes, True)
+  finally:
+    shutil.rmtree(root)
+
+
+class NullConsole(object):
+  """A console that prints nothing, so that only results are printed."""
+
+  def Print(self, s=''):
+    pass
+
+  def Error(self, s):
+    pass
+
+  def Flash(self, s):
+    pass
+
+  def SetMetrics(self, metrics):
+    pass
+
+
+def SyntheticFileSize(rng, distribution, mean_size):
+  """Returns a file size drawn from the distribution: 'fixed' (mean_size),
+  'uniform' (0 to 2 * mean_size) or 'lognormal' (median mean_size, with a
+  long tail of large files, like real trees)."""
+  if distribution == 'fixed':
+    return mean_size
+  if distribution == 'uniform':
+    return rng.randint(0, 2 * mean_size)
+  return int(rng.lognormvariate(0, 1.5) * mean_size)
+
+
+def SyntheticDirectory(i, depth, fanout):
+  """Returns the relative directory of the i-th leaf directory of a tree of
+  the given depth, where each directory has up to fanout subdirectories
+  (the top level has as many as needed)."""
+  components = []
+  for level in xrange(depth - 1):
+    components.append('d%03d' % (i % fanout))
+    i /= fanout
+  components.append('d%03d' % i)
+  components.reverse()
+  return os.path.join(*components)
+
+
+def MakeSyntheticTree(root, file_count, mean_size, distribution='lognormal',
+                      duplicate_ratio=0.2, depth=3, fanout=10,
+                      files_per_directory=100, seed=0):
+  """Creates file_count files under root, files_per_directory per leaf
+  directory at the given depth. A duplicate_ratio fraction of the files are
+  copies of an earlier file, the others have random contents with sizes
+  drawn from the distribution (see SyntheticFileSize). The same seed gives
+  the same tree. Returns the total size of the files."""
+  rng = random.Random(seed)
+  originals = []
+  total_bytes = 0
+  for i in xrange(file_count):
+    directory = os.path.join(
+        root, SyntheticDirectory(i / files_per_directory, depth, fanout))
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    filename = os.path.join(directory, 'f%07d' % i)
+    if originals and rng.random() < duplicate_ratio:
+      shutil.copyfile(rng.choice(originals), filename)
+    else:
+      size = SyntheticFileSize(rng, distribution, mean_size)
+      f = open(filename, 'wb')
+      # Starts with the index of the file, so that small files differ too.
+      prefix = ('%d\n' % i)[:size]
+      f.write(prefix)
+      f.write(os.urandom(size - len(prefix)))
+      f.close()
+      originals.append(filename)
+    total_bytes += os.path.getsize(filename)
+  return total_bytes
+
+
+class PhaseTimer(object):
+  """Accumulates the time and item count of the phases of a run."""
+
+  def __init__(self):
+    self.phases = collections.OrderedDict()
+
+  def Time(self, phase, function, items):
+    """Calls function(item) for each item, and adds the elapsed time."""
+    start = time.time()
+    for item in items:
+      function(item)
+    self.Add(phase, time.time() - start, len(items))
+
+  def Add(self, phase, seconds, count):
+    self.phases[phase] = collections.OrderedDict([
+        ('seconds', round(seconds, 6)),
+        ('count', count),
+        ('per_second', round(count / seconds, 1) if seconds else None),
+    ])
+
+
+def TimeScanPhases(database, root, args):
+  """Runs the phases of a scan of root one after the other, against the
+  database, and returns their PhaseTimer: walk (TreeWalker), stat, cache
+  lookup (FileStatsRepository.Get), hash (HashFile, files not in the
+  database), upsert (with the final flush), lookup (FileStatsRepository.
+  Lookup of sampled hashes) and name_like (FilePathMatch of sampled base
+  names)."""
+  timer = PhaseTimer()
+  console = NullConsole()
+  repository = dupes2.FileStatsRepository(database)
+  repository.CreateTable()
+  start = time.time()
+  entries = list(dupes2.TreeWalker(console).Walk([root], 'walk'))
+  timer.Add('walk', time.time() - start, len(entries))
+  filenames = [entry.GetFilename() for entry in entries]
+  stats = {}
+
+  def Stat(filename):
+    stats[filename] = os.lstat(filename)
+  timer.Time('stat', Stat, filenames)
+  to_hash = []
+
+  def CacheLookup(filename):
+    path, base_name = os.path.split(filename)
+    file_stats = repository.Get(path, base_name)
+    stat = stats[filename]
+    if not (file_stats and file_stats.GetHash()
+            and file_stats.GetTimestampSeconds() == int(stat.st_mtime)
+            and file_stats.GetSize() == stat.st_size):
+      to_hash.append(filename)
+  timer.Time('cache_lookup', CacheLookup, filenames)
+  hashes = {}
+
+  def Hash(filename):
+    hashes[filename] = dupes2.HashFile(filename, console)
+  timer.Time('hash', Hash, to_hash)
+
+  def Upsert(filename):
+    path, base_name = os.path.split(filename)
+    stat = stats[filename]
+    repository.Upsert(dupes2.FileStats(
+        path, base_name, hashes[filename], stat.st_size, int(stat.st_mtime),
+        'md5', None, stat.st_dev, stat.st_ino, dupes2.MtimeNs(stat)))
+  start = time.time()
+  for filename in to_hash:
+    Upsert(filename)
+  repository.Flush()
+  timer.Add('upsert', time.time() - start, len(to_hash))
+  rng = random.Random(args.seed)
+  samples = [rng.choice(filenames) for i in xrange(min(100, len(filenames)))]
+  lookups = []
+  for filename in samples:
+    path, base_name = os.path.split(filename)
+    file_stats = repository.Get(path, base_name)
+    lookups.append((file_stats.GetHash(), file_stats.GetSize()))
+  timer.Time('lookup', lambda (md5hash, size): repository.Lookup(md5hash, size),
+             lookups)
+  timer.Time('name_like', repository.FilePathMatch,
+             ['%%/%s' % os.path.basename(filename) for filename in samples])
+  repository.Close()
+  return timer
+
+
+def BenchmarkSuite(args):
+  """Generates a synthetic tree (see MakeSyntheticTree), then times the
+  phases of a scan (see TimeScanPhases) with an empty database (cold) and
+  again with the database of the first run (warm). Writes the parameters
+  and results as JSON to args.output, so that runs can be diffed. The tree
+  and the database are created under args.tmp_dir, which should be a local
+  disk or a tmpfs."""
+  root = tempfile.mkdtemp(prefix='dupes2_benchmark_', dir=args.tmp_dir)
+  try:
+    tree = os.path.join(root, 'tree')
+    start = time.time()
+    total_bytes = MakeSyntheticTree(
+        tree, args.files, args.file_size, args.size_distribution,
+        args.duplicate_ratio, args.depth, args.fanout,
+        args.files_per_directory, args.seed)
+    generate_seconds = time.time() - start
+    database = os.path.join(root, 'dupes.db')
+    runs = collections.OrderedDict()
+    for run in ('cold', 'warm'):
+      runs[run] = TimeScanPhases(database, tree, args).phases
+    result = collections.OrderedDict([
+        ('benchmark', 'suite'),
+        ('parameters', collections.OrderedDict([
+            ('files', args.files),
+            ('file_size', args.file_size),
+            ('size_distribution', args.size_distribution),
+            ('duplicate_ratio', args.duplicate_ratio),
+            ('depth', args.depth),
+            ('fanout', args.fanout),
+            ('files_per_directory', args.files_per_directory),
+            ('seed', args.seed),
+        ])),
+        ('environment', collections.OrderedDict([
+            ('python', platform.python_version()),
+            ('sqlite', sqlite3.sqlite_version),
+            ('platform', platform.platform()),
+            ('tmp_dir', args.tmp_dir or tempfile.gettempdir()),
+        ])),
+        ('tree', collections.OrderedDict([
+            ('bytes', total_bytes),
+            ('generate_seconds', round(generate_seconds, 3)),
+        ])),
+        ('runs', runs),
+    ])
+    output = dupes2.OpenOutput(args.output)
+    output.write(
+        json.dumps(result, indent=2, separators=(',', ': ')) + '\n')
+    if output is not sys.stdout:
+      output.close()
+  finally:
+    shutil.rmtree(root)
+
+
+BENCHMARKS = {
+  'disk_order': BenchmarkDiskOrder,
+  'hash_file': BenchmarkHashFile,
+  'hash_filter': BenchmarkHashFilter,
+  'migrate': BenchmarkMigrate,
+  'path_search': BenchmarkPathSearch,
+  'suite': BenchmarkSuite,
+}
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+      description='Benchmarks for dupes2.py',
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('benchmark', choices=sorted(BENCHMARKS),
+      help='the benchmark to run')
+  parser.add_argument('--files', metavar='count', type=int, default=10000,
+      help='number of files in the generated tree')
+  parser.add_argument('--file_size', metavar='bytes', type=int, default=4096,
+      help='size of each generated file')
+  parser.add_argument('--rows', metavar='count', type=int, default=1000000,
+      help='number of rows in the generated catalog')
+  parser.add_argument('--algorithm', metavar='name',
+      help='hash algorithm passed to dupes2.HashFile')
+  parser.add_argument('--tmp_dir', metavar='path',
+      help='where to create the generated tree (e.g. a tmpfs mount)')
+  parser.add_argument('--size_distribution',
+      choices=['fixed', 'uniform', 'lognormal'], default='lognormal',
+      help='suite: distribution of the file sizes, around --file_size')
+  parser.add_argument('--duplicate_ratio', metavar='ratio', type=float,
+      default=0.2,
+      help='suite: fraction of the files that are copies of another file')
+  parser.add_argument('--depth', metavar='N', type=int, default=3,
+      help='suite: depth of the directories that hold the files')
+  parser.add_argument('--fanout', metavar='N', type=int, default=10,
+      help='suite: subdirectories per directory')
+  parser.add_argument('--files_per_directory', metavar='N', type=int,
+      default=100,
+      help='suite: files per directory')
+  parser.add_argument('--seed', metavar='N', type=int, default=0,
+      help='suite: seed of the generated tree and of the sampled queries')
+  parser.add_argument('--output', metavar='path', default='-',
+      help='suite: where to write the json results (- for stdout)')
+  args = parser.parse_args()
+  BENCHMARKS[args.benchmark](args)